@@ -22,26 +22,115 @@
 # Website: https://github.com/abbarrasa/openbox
 #
 # A script to put a sensor monitor in system tray.
+#
+# Example of use: python2 sensors-trayicon.py -r 30
 
 import gtk
-import sensors as pysensors
 import psutil
 import os
 import gobject
 import base64
+import glob
+import threading
+import time
+
+from argparse import ArgumentParser
+from array import array
+from collections import deque
+
+try:
+    import sensors as pysensors
+except ImportError:
+    pysensors = None
 
 from gtk import gdk
 from xdg import BaseDirectory as base_directory
 
 
+def parse_arguments():
+    parser = ArgumentParser(description='A sensor monitor in systray',
+                            epilog='Free software under GPL license.'
+                            'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
+    parser.add_argument('-r', '--retention',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='minutes of sensor history kept and plotted')
+    args = parser.parse_args()
+    return args
+
+
+if hasattr(os, 'pread'):
+    def pread(fd, size):
+        return os.pread(fd, size, 0)
+else:
+    # Python 2 has no os.pread
+    def pread(fd, size):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class HwmonSensors:
+    """Temperature sensors read straight from sysfs. Inputs are found
+    once and kept open, every sample is a read of a few bytes."""
+    def __init__(self, root='/sys/class/hwmon'):
+        self.inputs = []
+        for path in sorted(glob.glob(os.path.join(root, '*', 'temp*_input'))):
+            directory, name = os.path.split(path)
+            feature = name[:-len('_input')]
+            # Named as libsensors does: chip prefix and feature name
+            chip = self.read_text(os.path.join(directory, 'name'))
+            if chip is None:
+                continue
+            label = self.read_text(
+                os.path.join(directory, feature + '_label')) or feature
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            self.inputs.append((chip + '_' + feature, label, fd))
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def read_text(self, path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def read(self):
+        """Yields the (sensor, label, degrees) of every readable input."""
+        for sensor, label, fd in self.inputs:
+            try:
+                value = int(pread(fd, 16))
+            except (OSError, ValueError):
+                # Sensors may fail while their device sleeps
+                continue
+            yield sensor, label, value / 1000.0
+
+    def close(self):
+        for sensor, label, fd in self.inputs:
+            os.close(fd)
+        self.inputs = []
+
+
 class Sensors:
     def __init__(self):
         self.__FEATURE_TEMP = 2
         self.sensors = {}
+        # libsensors is only walked when sysfs has no temperature inputs
+        self.hwmon = HwmonSensors()
+        # CPU usage is measured since the previous call, the first one
+        # only sets the start
+        psutil.cpu_percent(interval=None)
 
     def get_sensors(self):
         self.update_sensors()
-        return self.sensors
+        # A copy, so the caller may keep it while the next update runs
+        return dict((sensor, dict(value))
+                    for sensor, value in self.sensors.items())
 
     def append_sensor(self, sensor, label, format, value, value_alarm):
         self.sensors.update({
@@ -53,24 +142,31 @@ class Sensors:
             }
         })
 
+    def close(self):
+        self.hwmon.close()
+
     def update_sensors(self):
         # Temperature sensors
-        for chip in pysensors.iter_detected_chips():
-            for feature in chip:
-                if feature.type == self.__FEATURE_TEMP:
-                    self.append_sensor(
-                        chip.prefix + '_' + feature.name,
-                        feature.label,
-                        '%.1f ºC',
-                        feature.get_value(),
-                        100.0)
+        if len(self.hwmon):
+            for sensor, label, value in self.hwmon.read():
+                self.append_sensor(sensor, label, '%.1f ºC', value, 100.0)
+        elif pysensors is not None:
+            for chip in pysensors.iter_detected_chips():
+                for feature in chip:
+                    if feature.type == self.__FEATURE_TEMP:
+                        self.append_sensor(
+                            chip.prefix + '_' + feature.name,
+                            feature.label,
+                            '%.1f ºC',
+                            feature.get_value(),
+                            100.0)
 
         # Cpu usage
         self.append_sensor(
             'cpu',
             'CPU usage',
             '%.1f %%',
-            psutil.cpu_percent(interval=1),
+            psutil.cpu_percent(interval=None),
             95.0)
 
         # Memory usage
@@ -84,14 +180,187 @@ class Sensors:
             'swap', 'Swap usage', '%.1f %%', vswap.percent, 95.0)
 
 
+class SensorHistory:
+    """Last values of a sensor in a fixed size ring buffer. Minimum,
+    maximum and mean are kept up to date as values come and go."""
+    def __init__(self, size):
+        self.size = size
+        self.buffer = array('f', [0.0]) * size
+        self.count = 0
+        self.total = 0.0
+        # (position, value) of the values that may still become the
+        # minimum or maximum, from the oldest one
+        self.lows = deque()
+        self.highs = deque()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, value):
+        index = self.count % self.size
+        if self.count >= self.size:
+            self.total -= self.buffer[index]
+        # Kept as stored, so it is subtracted exactly when overwritten
+        self.buffer[index] = value
+        value = self.buffer[index]
+        self.total += value
+        if index == self.size - 1:
+            # Drop the rounding errors of the running total once a lap
+            self.total = sum(self.buffer)
+
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((self.count, value))
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((self.count, value))
+
+        self.count += 1
+        oldest = self.count - self.size
+        if self.lows[0][0] < oldest:
+            self.lows.popleft()
+        if self.highs[0][0] < oldest:
+            self.highs.popleft()
+
+    def min(self):
+        return self.lows[0][1] if self.count else None
+
+    def max(self):
+        return self.highs[0][1] if self.count else None
+
+    def mean(self):
+        return self.total / len(self) if self.count else None
+
+    def values(self):
+        """Returns the values from the oldest one."""
+        if self.count <= self.size:
+            return self.buffer[:self.count]
+        index = self.count % self.size
+        return self.buffer[index:] + self.buffer[:index]
+
+
+class HistoryWindow:
+    """Plots the history of every sensor, with its minimum, mean and
+    maximum."""
+    def __init__(self, histories):
+        self.histories = histories
+        self.rows = {}
+
+        self.window = gtk.Window()
+        self.window.set_title('Sensors history')
+        self.window.set_default_size(480, 400)
+        self.window.connect('delete-event', self.on_delete)
+        self.vbox = gtk.VBox(False, 6)
+        self.vbox.set_border_width(6)
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        scrolled.add_with_viewport(self.vbox)
+        self.window.add(scrolled)
+
+    def is_visible(self):
+        return self.window.get_visible()
+
+    def show(self, mysensors):
+        self.update(mysensors)
+        self.window.show_all()
+        self.window.present()
+
+    def on_delete(self, widget, event):
+        # Hidden, not destroyed, to be shown again
+        self.window.hide()
+        return True
+
+    def add_row(self, sensor):
+        label = gtk.Label()
+        label.set_alignment(0.0, 0.5)
+        area = gtk.DrawingArea()
+        area.set_size_request(-1, 60)
+        area.connect('expose-event', self.on_expose, sensor)
+        self.vbox.pack_start(label, False, False, 0)
+        self.vbox.pack_start(area, False, False, 0)
+        self.vbox.show_all()
+        self.rows[sensor] = (label, area)
+
+    def update(self, mysensors):
+        for sensor in sorted(mysensors):
+            history = self.histories.get(sensor)
+            if history is None or not len(history):
+                continue
+            if sensor not in self.rows:
+                self.add_row(sensor)
+            label, area = self.rows[sensor]
+            format = mysensors[sensor]['format']
+            label.set_markup('<b>{0}</b>: {1}  (min {2}, avg {3}, max {4})'.format(
+                mysensors[sensor]['label'], format % mysensors[sensor]['value'],
+                format % history.min(), format % history.mean(),
+                format % history.max()))
+            area.queue_draw()
+
+    def on_expose(self, area, event, sensor):
+        history = self.histories[sensor]
+        width, height = area.allocation.width, area.allocation.height
+        cr = area.window.cairo_create()
+        cr.set_source_rgb(1.0, 1.0, 1.0)
+        cr.rectangle(0, 0, width, height)
+        cr.fill()
+        if len(history) < 2:
+            return False
+
+        # The newest value on the right edge, the whole retention wide
+        low, high = history.min(), history.max()
+        span = (high - low) or 1.0
+        step = (width - 1) / float(history.size - 1)
+        values = history.values()
+        x = width - 1 - step * (len(values) - 1)
+        for value in values:
+            cr.line_to(x, height - 2 - (value - low) / span * (height - 4))
+            x += step
+        cr.set_source_rgb(0.2, 0.4, 0.8)
+        cr.set_line_width(1.5)
+        cr.stroke()
+        return False
+
+
+class SensorsCollector(threading.Thread):
+    """Samples the sensors every interval seconds off the GTK main loop
+    and hands every sample to a callback run by the main loop."""
+    def __init__(self, sensors, interval, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sensors = sensors
+        self.interval = interval
+        self.callback = callback
+        self.stopped = threading.Event()
+
+    def run(self):
+        # The first sample waits too, so CPU usage covers a whole
+        # interval since the one taken to build the menu
+        deadline = time.time()
+        while True:
+            # Keep the pace without catching up on missed samples
+            deadline = max(deadline + self.interval, time.time())
+            self.stopped.wait(deadline - time.time())
+            if self.stopped.is_set():
+                return
+            gobject.idle_add(self.callback, self.sensors.get_sensors())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 class SystrayIcon:
-    def __init__(self):
+    def __init__(self, args):
         self._APPNAME = 'Sensors TrayIcon'
         self._VERSION = '0.1'
         self._CONFIG_DIR = os.path.join(
             base_directory.xdg_config_home, 'sensors-trayicon')
+        self._INTERVAL = 2
+        self._HISTORY_SIZE = max(2, args.retention * 60 // self._INTERVAL)
 
         self.sensors = Sensors()
+        self.histories = {}
+        self.history_window = None
         self.tray = gtk.StatusIcon()
         self.tray.set_from_file(
             os.path.join(self._CONFIG_DIR, 'themes/default/trayicon.svg'))
@@ -101,7 +370,9 @@ class SystrayIcon:
 
         self.build_menu()
 
-        gobject.timeout_add(2000, self.update_menu)
+        self.collector = SensorsCollector(
+            self.sensors, self._INTERVAL, self.update_menu)
+        self.collector.start()
 
     def add_menu_item(self, title):
         menuitem = gtk.MenuItem()
@@ -119,12 +390,18 @@ class SystrayIcon:
     def build_menu(self):
         self.menu = gtk.Menu()
         self.items = {}
+        # Not added to the history, CPU usage is only measured since
+        # the sensors were created
         mysensors = self.sensors.get_sensors()
+        self.last_sensors = mysensors
 
         # show settings dialog
         self.items['preferences'] = self.add_menu_item('Preferences')
         self.items['preferences'].connect(
             "activate", lambda w: self.show_preferences_dialog())
+        self.items['history'] = self.add_menu_item('History')
+        self.items['history'].connect(
+            "activate", lambda w: self.show_history_window())
         self.add_separator()
 
         # Add menu items for sensors
@@ -188,20 +465,47 @@ class SystrayIcon:
         about_dialog.run()
         about_dialog.destroy()
 
-    def update_menu(self):
-        mysensors = self.sensors.get_sensors()
+    def add_history(self, mysensors):
         for sensor in mysensors:
+            if sensor not in self.histories:
+                self.histories[sensor] = SensorHistory(self._HISTORY_SIZE)
+            self.histories[sensor].append(mysensors[sensor]['value'])
+
+    def show_history_window(self):
+        if self.history_window is None:
+            self.history_window = HistoryWindow(self.histories)
+        self.history_window.show(self.last_sensors)
+
+    def update_menu(self, mysensors):
+        self.add_history(mysensors)
+        self.last_sensors = mysensors
+        if self.history_window is not None and self.history_window.is_visible():
+            self.history_window.update(mysensors)
+
+        for sensor in mysensors:
+            if sensor not in self.items:
+                continue
             label = '{0}: {1}'.format(
                 mysensors[sensor]['label'], mysensors[sensor]['format'])
             setlabel = label % mysensors[sensor]['value']
             self.items[sensor].set_label(setlabel)
 
-        return True
+        # Run once per sample
+        return False
 
 if __name__ == "__main__":
-    pysensors.init()
+    # The collector thread must run while the main loop waits
+    args = parse_arguments()
+    gobject.threads_init()
+    if pysensors is not None:
+        pysensors.init()
     try:
-        SystrayIcon()
-        gtk.main()
+        trayicon = SystrayIcon(args)
+        try:
+            gtk.main()
+        finally:
+            trayicon.collector.stop()
+            trayicon.sensors.close()
     finally:
-        pysensors.cleanup()
+        if pysensors is not None:
+            pysensors.cleanup()
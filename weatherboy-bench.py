@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# License: GPLv3
+# Website: https://github.com/abbarrasa/openbox
+#
+# Benchmarks of the weather parse and render paths of weatherboy and
+# weatherboy-qt, over the recorded responses of weatherboy-replay. It
+# reports ops/sec and peak memory of every benchmark. Render benchmarks
+# run offscreen and are skipped when their toolkit is not installed:
+# the overview needs Python 3 and PyQt5, the tooltip Python 2, pygtk and
+# a display (e.g. xvfb-run).
+#
+# Example of use: python3 weatherboy-bench.py
+#                 xvfb-run python2 weatherboy-bench.py -b tooltip
+
+from __future__ import division, print_function
+
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, only the peak memory of the whole process is known
+    tracemalloc = None
+    import resource
+
+from weatherboy_core import PROVIDERS, ResponseCache, YahooAPI, clock, conv_direction, to_time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures', 'yahoo')
+BENCHMARKS = ('parse', 'get_data', 'conv_direction', 'to_time', 'overview', 'tooltip')
+
+# Cleanups of the benchmarks run and objects they must keep alive
+BENCH_CLEANUP = []
+BENCH_STATE = {}
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Benchmarks of weatherboy and weatherboy-qt',
+                            epilog='Free software under GPL license.'
+                            'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
+    parser.add_argument('-b', '--bench',
+                        choices=BENCHMARKS,
+                        default=list(BENCHMARKS),
+                        nargs='+',
+                        help='benchmarks to run')
+    parser.add_argument('-f', '--fixtures',
+                        default=FIXTURES_DIR,
+                        metavar='DIR',
+                        help='directory of recorded weather channels')
+    parser.add_argument('-u', '--units',
+                        choices=['c', 'f'],
+                        default='c',
+                        metavar='c|f',
+                        help='units of the recorded weather channels')
+    parser.add_argument('-n', '--size',
+                        default='100000',
+                        type=int,
+                        metavar='N',
+                        help='number of synthetic inputs for conv_direction and to_time')
+    parser.add_argument('-t', '--time',
+                        default='0.5',
+                        type=float,
+                        metavar='SECONDS',
+                        help='minimum time of every measure')
+    parser.add_argument('-r', '--repeat',
+                        default='3',
+                        type=int,
+                        metavar='N',
+                        help='measures of every benchmark, the best one is reported')
+    args = parser.parse_args()
+    return args
+
+
+class Skipped(Exception):
+    pass
+
+
+def load_fixtures(directory, units):
+    """Returns the WOEIDs and the YQL response of every recorded location
+    in the given units, as the API answers a batched query."""
+    woeids, channels = [], []
+    suffix = '-{0}.json'.format(units)
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(suffix):
+            with open(os.path.join(directory, name)) as f:
+                channels.append(json.load(f))
+            woeids.append(name[:-len(suffix)])
+    if not channels:
+        raise Exception("No fixtures in {0}".format(directory))
+    response = {'query': {'count': len(channels), 'results': {'channel': channels}}}
+    return woeids, response
+
+
+def load_records(response):
+    api = YahooAPI()
+    api.checked = datetime.now()
+    return PROVIDERS['yahoo'](api).parse(response)
+
+
+def bench_parse(args, woeids, response):
+    provider = PROVIDERS['yahoo'](YahooAPI())
+    return lambda: provider.parse(response), 1
+
+
+def bench_get_data(args, woeids, response):
+    # Served by the on-disk cache, as on startup and while offline
+    directory = tempfile.mkdtemp(prefix='weatherboy-bench')
+    api = YahooAPI(ResponseCache(0, directory))
+    provider = PROVIDERS['yahoo'](api)
+    api.cache.store(provider.query(woeids), response)
+    BENCH_CLEANUP.append(lambda: shutil.rmtree(directory, True))
+    return lambda: provider.forecast(woeids, offline=True), 1
+
+
+def bench_conv_direction(args, woeids, response):
+    rnd = random.Random(0)
+    inputs = [rnd.randint(0, 359) for i in range(args.size)]
+
+    def run():
+        for degrees in inputs:
+            conv_direction(degrees)
+    return run, len(inputs)
+
+
+def bench_to_time(args, woeids, response):
+    rnd = random.Random(0)
+    inputs = ['{0}:{1:02} {2}'.format(rnd.randint(1, 12), rnd.randint(0, 59), rnd.choice(('am', 'pm')))
+              for i in range(args.size)]
+
+    def run():
+        for value in inputs:
+            to_time(value)
+    return run, len(inputs)
+
+
+def bench_overview(args, woeids, response):
+    if sys.version_info[0] < 3:
+        raise Skipped('needs Python 3')
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication
+    except ImportError:
+        raise Skipped('needs PyQt5')
+
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('weatherboy_qt', os.path.join(BASE_DIR, 'weatherboy-qt.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    BENCH_STATE['qapp'] = QApplication.instance() or QApplication(sys.argv[:1])
+    records = load_records(response)
+    dialog = module.OverviewDialog()
+    BENCH_STATE['dialog'] = dialog
+    return lambda: dialog.set_data(records, args.units), 1
+
+
+def bench_tooltip(args, woeids, response):
+    if sys.version_info[0] > 2:
+        raise Skipped('needs Python 2')
+    try:
+        import weatherboy
+    except (ImportError, RuntimeError):
+        raise Skipped('needs pygtk and a display')
+
+    # A client of a daemon that is not there neither fetches nor polls
+    sys.argv[1:] = ['--client', '--advanced', '--socket', os.devnull]
+    app = weatherboy.MainApp(weatherboy.parse_arguments())
+    records = load_records(response)
+
+    def run():
+        for record in records:
+            app.build_tooltip(record).destroy()
+    return run, len(records)
+
+
+def measure(func, min_time):
+    """Returns the (calls, seconds) of a run of at least min_time seconds."""
+    calls = 1
+    while True:
+        start = clock()
+        for i in range(calls):
+            func()
+        elapsed = clock() - start
+        if elapsed >= min_time:
+            return calls, elapsed
+        calls *= 2
+
+
+def peak_memory(func):
+    """Returns the peak memory in KiB allocated by a call, or the peak
+    of the whole process when allocations cannot be traced."""
+    if tracemalloc is None:
+        func()
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main(args):
+    woeids, response = load_fixtures(args.fixtures, args.units)
+    print('{0} locations, Python {1}.{2}'.format(len(woeids), *sys.version_info[:2]))
+    print('{0:<16} {1:>14} {2:>12}'.format('benchmark', 'ops/sec', 'peak KiB' if tracemalloc else 'maxrss KiB'))
+    for name in args.bench:
+        try:
+            func, ops = globals()['bench_' + name](args, woeids, response)
+        except Skipped as e:
+            print('{0:<16} skipped, {1}'.format(name, e))
+            continue
+
+        func()
+        rate = max(calls * ops / elapsed for calls, elapsed in
+                   (measure(func, args.time) for i in range(args.repeat)))
+        print('{0:<16} {1:>14,.0f} {2:>12,.0f}'.format(name, rate, peak_memory(func)))
+
+    for cleanup in BENCH_CLEANUP:
+        cleanup()
+
+
+if __name__ == "__main__":
+    try:
+        main(parse_arguments())
+    except KeyboardInterrupt:
+        pass
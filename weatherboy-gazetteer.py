@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# License: GPLv3
+# Website: https://github.com/abbarrasa/openbox
+#
+# Builds and queries the offline place index of weatherboy and
+# weatherboy-qt, used to find WOEIDs by name or by coordinates without
+# a network. Places are read from tab separated files with the columns
+# woeid, name, admin2, admin1, country, latitude and longitude, which
+# --fetch can fill with places found by the Yahoo! GeoPlanet API.
+#
+# Example of use: python3 weatherboy-gazetteer.py --fetch Madrid London -t places.tsv
+#                 python3 weatherboy-gazetteer.py --build places.tsv fixtures/gazetteer.tsv
+#                 python3 weatherboy-gazetteer.py --find mad
+#                 python3 weatherboy-gazetteer.py --near 40.4 -3.7
+
+from argparse import ArgumentParser
+import io
+import sys
+from weatherboy_core import GAZETTEER_PATH, PUBLIC_API_URL, Gazetteer, YahooAPI, yql_quote
+
+YQL_PLACES_BY_TEXT = "select woeid, name, country.content, admin1.content, admin2.content, centroid from geo.places(%d) where text='%s'"
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Offline place index of weatherboy',
+                            epilog='Free software under GPL license.'
+                            'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
+    parser.add_argument('-g', '--gazetteer',
+                        default=GAZETTEER_PATH,
+                        metavar='PATH',
+                        help='place index to build or query')
+    parser.add_argument('-b', '--build',
+                        nargs='+',
+                        metavar='TSV',
+                        help='build the place index from tab separated files')
+    parser.add_argument('--fetch',
+                        nargs='+',
+                        metavar='TEXT',
+                        help='append the places found by the API for every text to the file given by --tsv')
+    parser.add_argument('-t', '--tsv',
+                        metavar='TSV',
+                        help='tab separated file written by --fetch')
+    parser.add_argument('-f', '--find',
+                        metavar='TEXT',
+                        help='print the places whose name starts with TEXT')
+    parser.add_argument('-n', '--near',
+                        nargs=2,
+                        type=float,
+                        metavar=('LAT', 'LON'),
+                        help='print the place closest to some coordinates')
+    parser.add_argument('-l', '--limit',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='maximum number of places printed or fetched per text')
+    parser.add_argument('--api-url',
+                        default=PUBLIC_API_URL,
+                        metavar='URL',
+                        help='GeoPlanet API endpoint')
+    args = parser.parse_args()
+    if args.fetch and not args.tsv:
+        parser.error('argument --fetch requires --tsv')
+    if not (args.build or args.fetch or args.find or args.near):
+        parser.error('one of --build, --fetch, --find or --near is required')
+    return args
+
+
+def read_places(path):
+    with io.open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 7:
+                raise Exception("Bad place in {0}: {1}".format(path, line.strip()))
+            yield fields
+
+
+def fetch_places(api, text, limit):
+    data = api.query(YQL_PLACES_BY_TEXT % (limit, yql_quote(text)), cached=False)
+    places = data['query']['results']['place'] if data['query']['count'] else []
+    if not isinstance(places, list):
+        places = [places]
+    for place in places:
+        yield [place['woeid'], place['name'], place.get('admin2') or '', place.get('admin1') or '',
+               place.get('country') or '', place['centroid']['latitude'], place['centroid']['longitude']]
+
+
+def print_place(place):
+    print('{0}\t{1}\t{2:.4f}\t{3:.4f}'.format(place.woeid, place.label, place.latitude, place.longitude))
+
+
+if __name__ == "__main__":
+    try:
+        args = parse_arguments()
+        if args.fetch:
+            api = YahooAPI(url=args.api_url)
+            with io.open(args.tsv, 'a', encoding='utf-8') as f:
+                for text in args.fetch:
+                    for fields in fetch_places(api, text, args.limit):
+                        f.write('\t'.join(fields) + '\n')
+
+        if args.build:
+            places = [fields for path in args.build for fields in read_places(path)]
+            Gazetteer.build(places, args.gazetteer)
+            print('{0} places written to {1}'.format(len(places), args.gazetteer))
+
+        if args.find or args.near:
+            gazetteer = Gazetteer(args.gazetteer)
+            if args.find:
+                for place in gazetteer.search(args.find, args.limit):
+                    print_place(place)
+            if args.near:
+                place = gazetteer.nearest(*args.near)
+                if place is not None:
+                    print_place(place)
+            gazetteer.close()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
@@ -27,30 +27,55 @@
 # on <https://github.com/decayofmind/weatherboy>
 #
 # Example of use: python3 weatherboy-qt.py -l 22664159 -u c -d 30 -a
+#                 python3 weatherboy-qt.py -l 22664159 766273 -u c -d 30 -a
 
-from PyQt5.QtCore import QSize, QTimer, Qt
+from time import perf_counter
+
+# End of every startup phase, reported with --profile-startup
+startup_phases = [('start', perf_counter())]
+
+
+def startup_phase(name):
+    startup_phases.append((name, perf_counter()))
+
+
+from PyQt5.QtCore import QObject, QSize, QTimer, Qt, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import (QIcon, QTextCursor, QStandardItemModel,
     QStandardItem)
 from PyQt5.QtWidgets import (qApp, QApplication, QMainWindow,
-    QSystemTrayIcon, QMenu, QAction, QDialog, QDialogButtonBox,
-    QLabel, QTabWidget, QTextBrowser, QGridLayout, QHBoxLayout,
-    QVBoxLayout, QToolButton, QLineEdit, QSpacerItem, QSizePolicy,
-    QListView)
+    QSystemTrayIcon, QMenu, QAction, QActionGroup, QDialog,
+    QDialogButtonBox, QLabel, QTabWidget, QTextBrowser, QGridLayout,
+    QHBoxLayout, QVBoxLayout, QToolButton, QLineEdit, QSpacerItem, QSizePolicy,
+    QListView, QMessageBox, QWidget)
+startup_phase('import PyQt5')
+
 from argparse import ArgumentParser
-import urllib.request
-import urllib.parse
-import json
-import webbrowser
-import notify2
-import base64
-from decimal import Decimal
-from datetime import datetime, time
+import os
+import sys
+import threading
+from weatherboy_core import (PUBLIC_API_URL, PROVIDERS, SNAPSHOT_SOCKET,
+    UNITS, CACHE_DIR, Gazetteer, HistoryStore, LRUCache, PersistentLRUCache,
+    RefreshScheduler, RefreshStats, ResponseCache, YahooAPI, conv_direction,
+    decode_snapshot, diff_weather, format_age, format_percent, format_quantity,
+    format_temp, format_trend, next_sun_event, resolve_locations, yql_quote)
+startup_phase('import weatherboy_core')
+
+# Optional modules, loaded on first use
+notify2 = None
 
 # Yahoo! Weather YQL API
 WEATHER_WEBSITE = 'https://www.yahoo.com/news/weather/country/state/city-%s'
-PUBLIC_API_URL = 'http://query.yahooapis.com/v1/public/yql'
-YQL_FORECAST_BY_WOEID = "select * from weather.forecast where woeid='%s' and u='%s'"
-YQL_LOCATION_BY_TEXT = "select woeid, name, country.content, admin1.content, admin2.content from geo.places(10) where text='%s'"
+YQL_LOCATION_BY_TEXT = "select woeid, name, country.content, admin1.content, admin2.content from geo.places(%d) where text='%s'"
+
+# Location search as you type
+PLACES_LIMIT = 10
+PLACES_CACHE = os.path.join(CACHE_DIR, 'places.json')
+SEARCH_DELAY = 300
+
+# Session state through D-Bus
+LOGIN1_SERVICE = 'org.freedesktop.login1'
+LOGIN1_PATH = '/org/freedesktop/login1'
+LOGIN1_MANAGER = 'org.freedesktop.login1.Manager'
 
 # Application version
 VERSION = 1.4
@@ -108,39 +133,333 @@ ICON_NAMES = {
     '3200': 'weather-none-available'
 }
 
+# Codes worth a notification when the weather turns into them
+SEVERE_CODES = frozenset(code for code, name in ICON_NAMES.items()
+                         if name in ('weather-severe-alert', 'weather-storm'))
+
+# Seconds before an error that keeps happening is notified again
+ERROR_RENOTIFY = 15 * 60
+
+
+def init_notify2():
+    global notify2
+    if notify2 is None:
+        import notify2 as module
+        module.init('weather-qt')
+        notify2 = module
+    return notify2
+
+
+def report_startup():
+    print('Startup profile:', file=sys.stderr)
+    for (name, end), (_, start) in zip(startup_phases[1:], startup_phases):
+        print('  {0:<24} {1:8.1f} ms'.format(name, (end - start) * 1000), file=sys.stderr)
+    print('  {0:<24} {1:8.1f} ms'.format('total', (startup_phases[-1][1] - startup_phases[0][1]) * 1000), file=sys.stderr)
+
 
 def parse_arguments():
     parser = ArgumentParser(description='Simple weather applet',
                             epilog='Free software under GPL license.'
                             'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
     parser.add_argument('-l', '--location',
-                        required=True,
+                        default=[],
+                        nargs='+',
                         metavar='WOEID',
-                        help='location WOEID (more on https://developer.yahoo.com/weather/)')
+                        help='location WOEIDs or names in the offline gazetteer, one overview tab each (more on https://developer.yahoo.com/weather/)')
     parser.add_argument('-u', '--units',
                         choices=['c', 'f'],
                         default='c',
                         metavar='c|f',
-                        help='units to display')
+                        help='units to display, also switched from the menu')
     parser.add_argument('-d', '--delta',
                         default='10',
                         type=int,
                         metavar='N',
-                        help='timeout in minutes between next weather data query')
+                        help='minimum timeout in minutes between weather data queries; a longer ttl of the provider takes precedence')
+    parser.add_argument('-b', '--backoff',
+                        default='60',
+                        type=int,
+                        metavar='N',
+                        help='maximum timeout in minutes between retries after a connection error')
+    parser.add_argument('-t', '--ttl',
+                        default='5',
+                        type=int,
+                        metavar='N',
+                        help='time in minutes a cached weather data query is still valid')
+    parser.add_argument('-S', '--stale',
+                        default='120',
+                        type=int,
+                        metavar='N',
+                        help='time in minutes the last good weather data is still shown after errors')
+    parser.add_argument('-H', '--history',
+                        default='30',
+                        type=int,
+                        metavar='N',
+                        help='days of weather history kept for trends, 0 to keep none')
+    parser.add_argument('--notify-above',
+                        type=float,
+                        metavar='DEGREES',
+                        help='notify when the temperature rises above DEGREES')
+    parser.add_argument('--notify-below',
+                        type=float,
+                        metavar='DEGREES',
+                        help='notify when the temperature falls below DEGREES')
+    parser.add_argument('-p', '--provider',
+                        choices=sorted(PROVIDERS),
+                        default='yahoo',
+                        help='weather data provider')
+    parser.add_argument('--api-url',
+                        default=PUBLIC_API_URL,
+                        metavar='URL',
+                        help='weather API endpoint (e.g. a local weatherboy-replay server)')
+    parser.add_argument('-T', '--timeout',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='timeout in seconds for a weather data query')
     parser.add_argument('-a', '--advanced', action='store_true', default=False, help='Advanced tooltip')
+    parser.add_argument('--profile-startup', action='store_true', default=False,
+                        help='report the time spent in every startup phase')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='report the percentiles of every refresh phase after each refresh')
+    parser.add_argument('--stats-log',
+                        metavar='FILE',
+                        help='append the timings of every refresh to FILE, as JSON lines')
+    parser.add_argument('-c', '--client', action='store_true', default=False,
+                        help='only show the weather published by weatherboyd')
+    parser.add_argument('-s', '--socket',
+                        default=SNAPSHOT_SOCKET,
+                        metavar='PATH',
+                        help='Unix socket of weatherboyd')
     args = parser.parse_args()
+    if not args.client and not args.location:
+        parser.error('the following arguments are required: -l/--location')
+    try:
+        args.location = resolve_locations(args.location)
+    except Exception as e:
+        parser.error(str(e))
     return args
 
 
-class YahooAPI(object):
-    def query(self, yql):
+class IconCache(object):
+    """QIcons and their pixmaps by name and size. QIcon.fromTheme and
+    the pixmap rendering are done once per theme, the cache is dropped
+    when QIcon.themeName() changes."""
+    def __init__(self, maxsize=128):
+        self.cache = LRUCache(maxsize)
+        self.theme = None
+
+    def check_theme(self):
+        theme = QIcon.themeName()
+        if theme != self.theme:
+            self.cache.clear()
+            self.theme = theme
+
+    def icon(self, name):
+        self.check_theme()
+        icon = self.cache.get((name, None))
+        if icon is None:
+            icon = QIcon.fromTheme(name)
+            self.cache.put((name, None), icon)
+        return icon
+
+    def pixmap(self, name, size):
+        self.check_theme()
+        pixmap = self.cache.get((name, size))
+        if pixmap is None:
+            pixmap = self.icon(name).pixmap(QSize(size, size))
+            self.cache.put((name, size), pixmap)
+        return pixmap
+
+
+# Process-wide icon cache
+ICONS = IconCache()
+
+
+class Fetcher(QObject):
+    """Runs a blocking call in a worker thread and delivers its result
+    to the GUI thread by signal. A cancelled fetcher never emits."""
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+    def __init__(self, func):
+        super(Fetcher, self).__init__()
+        self.func = func
+        self.cancelled = False
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            if not self.cancelled:
+                self.failed.emit(e)
+        else:
+            if not self.cancelled:
+                self.succeeded.emit(result)
+
+
+class SessionMonitor(QObject):
+    """Follows suspend/resume and idleness through logind, and network
+    state through Qt bearer management. When they are not available the
+    session is always considered active and online."""
+    resumed = pyqtSignal()
+    online = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super(SessionMonitor, self).__init__(parent)
+        from PyQt5.QtDBus import QDBusConnection, QDBusInterface
+        from PyQt5.QtNetwork import QNetworkConfigurationManager
+
+        self.network = QNetworkConfigurationManager(self)
+        self.network.onlineStateChanged.connect(self.on_online_state_changed)
+
+        bus = QDBusConnection.systemBus()
+        bus.connect(LOGIN1_SERVICE, LOGIN1_PATH, LOGIN1_MANAGER,
+                    'PrepareForSleep', self.on_prepare_for_sleep)
+        self.login1 = QDBusInterface(LOGIN1_SERVICE, LOGIN1_PATH, LOGIN1_MANAGER, bus, self)
+
+    @pyqtSlot(bool)
+    def on_prepare_for_sleep(self, sleeping):
+        if not sleeping:
+            self.resumed.emit()
+
+    def on_online_state_changed(self, online):
+        if online:
+            self.online.emit()
+
+    def is_online(self):
+        if not self.network.allConfigurations():
+            return True
+        return self.network.isOnline()
+
+    def is_idle(self):
+        if not self.login1.isValid():
+            return False
+        return bool(self.login1.property('IdleHint'))
+
+
+class SnapshotClient(QObject):
+    """weatherboyd client on a QLocalSocket, delivering snapshots and
+    errors by signal. It reconnects every RETRY seconds while the daemon
+    is not available."""
+    received = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+    # Seconds between connection attempts
+    RETRY = 10
+
+    def __init__(self, path, parent=None):
+        super(SnapshotClient, self).__init__(parent)
+        from PyQt5.QtNetwork import QLocalSocket
+
+        self.path = path
+        self.socket = QLocalSocket(self)
+        self.socket.readyRead.connect(self.on_ready_read)
+        self.socket.disconnected.connect(self.on_disconnected)
+        self.socket.error.connect(self.on_disconnected)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.connect_to_daemon)
+
+    def connect_to_daemon(self):
+        self.socket.abort()
+        self.socket.connectToServer(self.path)
+
+    def refresh(self):
+        if self.socket.state() == self.socket.ConnectedState:
+            self.socket.write(b'refresh\n')
+
+    def on_ready_read(self):
+        while self.socket.canReadLine():
+            try:
+                records, error = decode_snapshot(bytes(self.socket.readLine()))
+            except (ValueError, KeyError, TypeError):
+                continue
+            if error is not None:
+                self.failed.emit(Exception(error))
+            else:
+                self.received.emit(records)
+
+    def on_disconnected(self, *args):
+        if not self.timer.isActive():
+            self.failed.emit(Exception("Weather daemon not available!"))
+            self.timer.start(self.RETRY * 1000)
+
+
+class Notifier(object):
+    """Desktop notifications of meaningful weather changes and of errors.
+
+    Every snapshot is diffed against the previous one and all of its
+    changes go in a single notification. Errors share one notification
+    which is updated in place: the same error again only bumps a counter
+    and reaches D-Bus at most every ERROR_RENOTIFY seconds.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.previous = None
+        self.error_notification = None
+        self.error_message = None
+        self.error_count = 0
+        self.error_shown = 0
+
+    def send(self, summary, body, icon, notification=None):
+        """Shows a new notification, or updates one in place, and returns
+        it. notify2 is loaded here, so a desktop without notifications
+        only gets a message printed."""
         try:
-            url = PUBLIC_API_URL + '?' + urllib.parse.urlencode({'q': yql, 'format': 'json'})
-            response = urllib.request.urlopen(url).read()
-            data = json.loads(response.decode('utf-8'))
-            return data
-        except:
-            raise Exception("Connection error!")
+            if notification is None:
+                notification = init_notify2().Notification(summary, body, icon)
+            else:
+                notification.update(summary, body, icon)
+            notification.show()
+        except Exception as e:
+            print('Notification failed: {0}'.format(e))
+        return notification
+
+    def weather(self, data):
+        if self.error_notification is not None:
+            try:
+                self.error_notification.close()
+            except Exception:
+                pass
+            self.error_notification = None
+
+        previous, self.previous = self.previous, data
+        if previous is None:
+            return
+        changes = diff_weather(previous, data, ICON_NAMES, SEVERE_CODES, self.args.units,
+                               self.args.notify_above, self.args.notify_below)
+        if not changes:
+            return
+        body = '\n'.join(u'{0}: {1}'.format(city, text) for city, text in changes)
+        icon = data[0].icon(ICON_NAMES)
+        self.send('Weather changes', body, icon)
+
+    def error(self, e):
+        msg = str(e)
+        now = perf_counter()
+        if self.error_notification is None:
+            self.error_count = 0
+        elif msg != self.error_message:
+            self.error_count = 0
+        elif now - self.error_shown < ERROR_RENOTIFY:
+            self.error_count += 1
+            return
+
+        self.error_count += 1
+        if self.error_count > 1:
+            msg = '{0} ({1} times)'.format(msg, self.error_count)
+        self.error_notification = self.send('Weatherboy-Qt error!', msg, 'stock-dialog-error',
+                                            self.error_notification)
+        self.error_message = str(e)
+        self.error_shown = now
 
 
 class SystemTrayIcon(QSystemTrayIcon):
@@ -152,8 +471,20 @@ class SystemTrayIcon(QSystemTrayIcon):
         refresh_action.triggered.connect(parent.on_refresh)
         location_action = QAction(self.tr('&Change location'), self)
         location_action.triggered.connect(parent.on_change_location)
+        location_action.setEnabled(not parent.args.client)
         overview_action = QAction(self.tr('&Show overview'), self)
         overview_action.triggered.connect(parent.on_show_overview)
+        stats_action = QAction(self.tr('S&tatistics'), self)
+        stats_action.triggered.connect(parent.on_show_stats)
+        traymenu = QMenu()
+        units_menu = QMenu(self.tr('&Units'), traymenu)
+        units_group = QActionGroup(self)
+        for units in sorted(UNITS):
+            units_action = QAction(u'\u00B0{0}'.format(UNITS[units]['temperature']), units_group)
+            units_action.setCheckable(True)
+            units_action.setChecked(units == parent.args.units)
+            units_action.triggered.connect(lambda checked, units=units: parent.on_set_units(units))
+            units_menu.addAction(units_action)
         open_action = QAction(self.tr('&Open website'), self)
         open_action.triggered.connect(parent.on_open_website)
         about_action = QAction(self.tr('&About'), self)
@@ -163,10 +494,11 @@ class SystemTrayIcon(QSystemTrayIcon):
         quit_action.setIcon(QIcon.fromTheme("application-exit"))
         quit_action.triggered.connect(parent.on_quit)
 
-        traymenu = QMenu()
         traymenu.addAction(refresh_action)
         traymenu.addAction(location_action)
         traymenu.addAction(overview_action)
+        traymenu.addAction(stats_action)
+        traymenu.addMenu(units_menu)
         traymenu.addSeparator()
         traymenu.addAction(open_action)
         traymenu.addSeparator()
@@ -177,9 +509,12 @@ class SystemTrayIcon(QSystemTrayIcon):
         self.activated.connect(parent.on_show_overview)
         self.show()
 
-    def update(self, data):
-        icon = QIcon.fromTheme(data['current']['icon'])
-        tooltip_text = '{0} ({1}) in {2}, {3}'.format(data['current']['temp'], data['current']['text'], data['location']['city'], data['location']['country'])
+    def update(self, data, units, error=None):
+        # The icon shows the first location, the tooltip all of them
+        icon = ICONS.icon(data[0].icon(ICON_NAMES))
+        tooltip_text = '\n'.join('{0} ({1}) in {2}, {3}'.format(format_temp(item.temp, units), item.text, item.city, item.country) for item in data)
+        if error is not None:
+            tooltip_text += '\n{0} Showing data from {1} ago.'.format(error, format_age(data[0].age()))
         self.setIcon(icon)
         self.setToolTip(tooltip_text)
 
@@ -188,8 +523,150 @@ class SystemTrayIcon(QSystemTrayIcon):
         self.setIcon(QIcon.fromTheme('dialog-error', QIcon('stock-dialog-error')))
         self.setToolTip(msg)
 
-        n = notify2.Notification('Weatherboy-Qt error!', msg, 'stock-dialog-error')
-        n.show()
+
+class ForecastDay(QVBoxLayout):
+    def __init__(self, parent=None):
+        super(ForecastDay, self).__init__(parent)
+        self.iconLabel = QLabel()
+        self.iconLabel.setAlignment(Qt.AlignCenter)
+        self.dateLabel = QLabel()
+        self.textLabel = QLabel()
+        self.highLabel = QLabel()
+        self.lowLabel = QLabel()
+        for label in self.labels():
+            self.addWidget(label)
+
+    def labels(self):
+        return (self.iconLabel, self.dateLabel, self.textLabel, self.highLabel, self.lowLabel)
+
+    def set_data(self, item, units):
+        self.iconLabel.setPixmap(ICONS.pixmap(ICON_NAMES.get(item.code), 48))
+        self.dateLabel.setText('<font size="2"><b>{0}, {1}</b></font>'.format(item.day, item.date))
+        self.textLabel.setText('<font size="2">{0}</font>'.format(item.text))
+        self.highLabel.setText(u'<font size="2"><b>Max:</b> {0}</font>'.format(format_temp(item.high, units)))
+        self.lowLabel.setText(u'<font size="2"><b>Min:</b> {0}</font>'.format(format_temp(item.low, units)))
+
+    def setVisible(self, visible):
+        for label in self.labels():
+            label.setVisible(visible)
+
+
+class OverviewPage(QWidget):
+    """Weather overview of a single location."""
+    def __init__(self, parent=None):
+        super(OverviewPage, self).__init__(parent)
+
+        self.weatherLabel = QLabel()
+        self.windLabel = QLabel()
+        self.humidityLabel = QLabel()
+        self.visibilityLabel = QLabel()
+        self.pressureLabel = QLabel()
+        self.sunriseLabel = QLabel()
+        self.sunsetLabel = QLabel()
+        conditionsLayout = QVBoxLayout()
+        conditionsLayout.addWidget(self.weatherLabel)
+        conditionsLayout.addWidget(self.windLabel)
+        conditionsLayout.addWidget(self.humidityLabel)
+        conditionsLayout.addWidget(self.visibilityLabel)
+        conditionsLayout.addWidget(self.pressureLabel)
+        conditionsLayout.addWidget(self.sunriseLabel)
+        conditionsLayout.addWidget(self.sunsetLabel)
+
+        self.iconLabel = QLabel()
+
+        todayLayout = QHBoxLayout()
+        todayLayout.addWidget(self.iconLabel)
+        todayLayout.addLayout(conditionsLayout)
+
+        self.cityLabel = QLabel()
+
+        overviewLayout = QVBoxLayout()
+        overviewLayout.setAlignment(Qt.AlignHCenter)
+        overviewLayout.setContentsMargins(0, 0, 0, 20)
+        overviewLayout.addWidget(self.cityLabel)
+        overviewLayout.addLayout(todayLayout)
+
+        self.forecastLayout = QGridLayout()
+        self.forecastLayout.setContentsMargins(0, 0, 0, 20)
+        self.forecastDays = []
+
+        self.trendLabel = QLabel()
+
+        self.lastupdateLabel = QLabel()
+
+        layout = QVBoxLayout()
+        layout.addLayout(overviewLayout)
+        layout.addLayout(self.forecastLayout)
+        layout.addWidget(self.trendLabel)
+        layout.addWidget(self.lastupdateLabel)
+        self.setLayout(layout)
+
+    def set_data(self, data, units, trends=None):
+        self.weatherLabel.setText('<font size="4"><b>{0} ({1})</b></font>'.format(format_temp(data.temp, units), data.text))
+        self.windLabel.setText('<font size="2"><b>Wind:</b> {0} {1}</font>'.format(format_quantity(data.wind_speed, 'speed', units), conv_direction(data.wind_direction)))
+        self.humidityLabel.setText('<font size="2"><b>Humidity:</b> {0}</font>'.format(format_percent(data.humidity)))
+        self.visibilityLabel.setText('<font size="2"><b>Visibility:</b> {0}</font>'.format(format_quantity(data.visibility, 'distance', units)))
+        self.pressureLabel.setText('<font size="2"><b>Pressure:</b> {0}</font>'.format(format_quantity(data.pressure, 'pressure', units)))
+        self.sunriseLabel.setText(u'<font size="2"><b>Sunrise:</b> {0:%R} \u2600 </font>'.format(data.sunrise))
+        self.sunsetLabel.setText(u'<font size="2"><b>Sunset:</b> {0:%R} \u263E </font>'.format(data.sunset))
+
+        self.iconLabel.setPixmap(ICONS.pixmap(data.icon(ICON_NAMES), 128))
+
+        self.cityLabel.setText('<font size="5"><b>{0}, {1}</b></font>'.format(data.city, data.country))
+
+        # Forecast days are only created the first time they are needed
+        # and hidden when a response brings fewer of them.
+        while len(self.forecastDays) < len(data.forecast):
+            column = len(self.forecastDays)
+            day = ForecastDay()
+            self.forecastLayout.addLayout(day, column // 5, column % 5)
+            self.forecastDays.append(day)
+        for i, day in enumerate(self.forecastDays):
+            if i < len(data.forecast):
+                day.set_data(data.forecast[i], units)
+                day.setVisible(True)
+            else:
+                day.setVisible(False)
+
+        # Trends of the history, a time range per line
+        trends = [u'<b>{0}:</b> {1}'.format(label, format_trend(trend, units))
+                  for label, trend in (trends or {}).get(data.woeid, [])]
+        self.trendLabel.setText(u'<font size="2">{0}</font>'.format('<br>'.join(trends)))
+        self.trendLabel.setVisible(bool(trends))
+
+        self.lastupdateLabel.setText('<small><i>Last update at: {0:%Y-%m-%d %H:%M:%S}</i></small>'.format(data.checked))
+
+
+class OverviewDialog(QDialog):
+    """Weather overview built once and updated in place, with a tab
+    per location."""
+    def __init__(self, parent=None):
+        super(OverviewDialog, self).__init__(parent)
+        self.setWindowTitle('Weather status')
+        self.setGeometry(300, 300, 640, 480)
+        self.setWindowIcon(QIcon.fromTheme('indicator-weather', QIcon(':/indicator-weather.png')))
+
+        self.tabWidget = QTabWidget()
+        self.tabWidget.setTabBarAutoHide(True)
+
+        buttonBox = QDialogButtonBox(QDialogButtonBox.Ok, Qt.Horizontal, self)
+        buttonBox.accepted.connect(self.accept)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.tabWidget)
+        layout.addWidget(buttonBox)
+        self.setLayout(layout)
+
+    def set_data(self, data, units, trends=None):
+        while self.tabWidget.count() > len(data):
+            page = self.tabWidget.widget(self.tabWidget.count() - 1)
+            self.tabWidget.removeTab(self.tabWidget.count() - 1)
+            page.deleteLater()
+        while self.tabWidget.count() < len(data):
+            self.tabWidget.addTab(OverviewPage(), '')
+        for i, item in enumerate(data):
+            self.tabWidget.widget(i).set_data(item, units, trends)
+            self.tabWidget.setTabText(i, item.city)
 
 
 class MainApp(QMainWindow):
@@ -197,116 +674,172 @@ class MainApp(QMainWindow):
         super(MainApp, self).__init__(parent)
 
         self.args = args
-        self.api = YahooAPI()
-
-        # Init notficiations
-        notify2.init('weather-qt')
+        self.stats = RefreshStats(log=args.stats_log)
+        self.refresh_started = None
+        self.api = YahooAPI(ResponseCache(args.ttl), args.timeout, args.api_url, stats=self.stats)
+        self.provider = PROVIDERS[args.provider](self.api)
+        self.fetchers = {}
+
+        # Results of location searches, by normalized text. Searches
+        # have their own connection and stay out of the refresh stats.
+        self.places = PersistentLRUCache(PLACES_CACHE, 256)
+        self.places_api = YahooAPI(timeout=args.timeout, url=args.api_url)
+        self.gazetteer = None
+        self.history = HistoryStore(retention=args.history) if args.history > 0 else None
+        self.trends = {}
+        self.notifier = Notifier(args)
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.timeout.connect(self.search)
+
+        # Latest parsed weather data and the error of the refreshes
+        # failed since then
+        self.data = None
+        self.error = None
+        self.overview = None
 
         # Init tray icon
         self.trayicon = SystemTrayIcon(self)
+        startup_phase('tray icon')
+
+        self.scheduler = RefreshScheduler(args.delta, args.backoff)
+        self.monitor = None
+        self.client = None
 
         self.timer = QTimer(self)
-        self.timer.timeout.connect(self.refresh)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.on_timer)
+
+        # Switches between day and night icons when the sun rises or
+        # sets, between polls
+        self.sunTimer = QTimer(self)
+        self.sunTimer.setSingleShot(True)
+        self.sunTimer.timeout.connect(self.on_sun_timer)
+
+        # Everything else waits until the event loop has put the tray
+        # icon on screen
+        QTimer.singleShot(0, self.start)
+
+    def start(self):
+        startup_phase('event loop')
+
+        if self.args.client:
+            self.client = SnapshotClient(self.args.socket, self)
+            self.client.received.connect(self.on_data)
+            self.client.failed.connect(self.show_refresh_error)
+            self.client.connect_to_daemon()
+            startup_phase('daemon client')
+            if self.args.profile_startup:
+                report_startup()
+            return
+
+        # Paint the last good data right away and revalidate it
+        try:
+            self.data = self.get_data(offline=True)
+            self.notifier.previous = self.data
+            self.render()
+        except Exception:
+            pass
+        startup_phase('cached data')
+
+        self.monitor = SessionMonitor(self)
+        self.monitor.resumed.connect(self.on_resume)
+        self.monitor.online.connect(self.on_online)
+        startup_phase('session monitor')
+
         self.refresh()
+        startup_phase('refresh started')
+
+        if self.args.profile_startup:
+            report_startup()
 
     def on_refresh(self, widget):
         self.refresh()
 
     def on_open_website(self, widget):
-        url = WEATHER_WEBSITE % self.args.location
-        webbrowser.open(url)
+        import webbrowser
+        if self.data:
+            woeid = self.data[0].woeid
+        elif self.args.location:
+            woeid = self.args.location[0]
+        else:
+            return
+        webbrowser.open(WEATHER_WEBSITE % woeid)
 
     def on_quit(self, widget):
         qApp.quit()
 
+    def cancel(self, name):
+        fetcher = self.fetchers.pop(name, None)
+        if fetcher is not None:
+            fetcher.cancel()
+            if name == 'refresh':
+                self.stats.discard()
+
+    def fetch(self, name, func, callback, errback=None):
+        """Runs func off the GUI thread and passes its result to callback,
+        or its error to errback. A newer fetch with the same name cancels
+        the one in flight."""
+        self.cancel(name)
+
+        fetcher = Fetcher(func)
+        fetcher.succeeded.connect(
+            lambda result, fetcher=fetcher: self.on_fetched(name, fetcher, callback, result))
+        fetcher.failed.connect(
+            lambda e, fetcher=fetcher: self.on_fetched(name, fetcher, errback or self.on_error, e))
+        self.fetchers[name] = fetcher
+        fetcher.start()
+
+    def on_fetched(self, name, fetcher, callback, result):
+        # A result may already be queued when the fetcher is cancelled
+        if self.fetchers.get(name) is not fetcher:
+            return
+        del self.fetchers[name]
+        callback(result)
+
+    def on_error(self, e):
+        print(str(e))
+        self.trayicon.error(e)
+        self.notifier.error(e)
+
     def on_show_overview(self, widget):
-        print("Opening a new popup window...")
+        if self.data is None and self.client is not None:
+            return
+        if self.data is None:
+            self.fetch('overview', self.get_data, self.on_overview_data)
+            return
+
+        self.show_overview(self.data)
+        if not self.api.cache.is_fresh(self.data[0].checked):
+            self.refresh()
+
+    def on_show_stats(self, widget):
+        QMessageBox.information(self, self.tr('Refresh statistics'),
+                                '<pre>{0}</pre>'.format(self.stats.report()))
+
+    def on_overview_data(self, data):
+        self.on_data(data)
+        self.show_overview(data)
+
+    def show_overview(self, data):
         try:
-            data = self.get_data()
-
-            dialog = QDialog(self)
-            dialog.setWindowTitle('Weather status')
-            dialog.setGeometry(300, 300, 640, 480)
-            dialog.setWindowIcon(QIcon.fromTheme('indicator-weather', QIcon(':/indicator-weather.png')))
-
-            conditionsLayout = QVBoxLayout()
-            weatherLabel = QLabel('<font size="4"><b>{0} ({1})</b></font>'.format(data['current']['temp'], data['current']['text']))
-            windLabel = QLabel('<font size="2"><b>Wind:</b> {0} {1}</font>'.format(data['extra']['wind']['speed'], data['extra']['wind']['direction']))
-            humidityLabel = QLabel('<font size="2"><b>Humidity:</b> {0}</font>'.format(data['extra']['atmosphere']['humidity']))
-            visibilityLabel = QLabel('<font size="2"><b>Visibility:</b> {0}</font>'.format(data['extra']['atmosphere']['visibility']))
-            pressureLabel = QLabel('<font size="2"><b>Pressure:</b> {0}</font>'.format(data['extra']['atmosphere']['pressure']))
-            sunriseLabel = QLabel('<font size="2"><b>Sunrise:</b> {0}</font>'.format(data['extra']['astronomy']['sunrise']))
-            sunsetLabel = QLabel('<font size="2"><b>Sunset:</b> {0}</font>'.format(data['extra']['astronomy']['sunset']))
-            conditionsLayout.addWidget(weatherLabel)
-            conditionsLayout.addWidget(windLabel)
-            conditionsLayout.addWidget(humidityLabel)
-            conditionsLayout.addWidget(visibilityLabel)
-            conditionsLayout.addWidget(pressureLabel)
-            conditionsLayout.addWidget(sunriseLabel)
-            conditionsLayout.addWidget(sunsetLabel)
-
-            icon = QIcon.fromTheme(data['current']['icon'])
-            pixmap = icon.pixmap(QSize(128, 128))
-            iconLabel = QLabel()
-            iconLabel.setPixmap(pixmap)
-
-            todayLayout = QHBoxLayout()
-            todayLayout.addWidget(iconLabel)
-            todayLayout.addLayout(conditionsLayout)
-
-            cityLabel = QLabel('<font size="5"><b>{0}, {1}</b></font>'.format(data['location']['city'], data['location']['country']))
-
-            overviewLayout = QVBoxLayout()
-            overviewLayout.setAlignment(Qt.AlignHCenter)
-            overviewLayout.setContentsMargins(0, 0, 0, 20)
-            overviewLayout.addWidget(cityLabel)
-            overviewLayout.addLayout(todayLayout)
-
-            forecastLayout = QGridLayout()
-            forecastLayout.setContentsMargins(0, 0, 0, 20)
-            column = 0
-            for item in data['forecast']:
-                dateforecastLayout = QVBoxLayout()
-                icon = QIcon.fromTheme(ICON_NAMES.get(item['code']))
-                pixmap = icon.pixmap(QSize(48, 48))
-                iconLabel = QLabel()
-                iconLabel.setAlignment(Qt.AlignCenter)
-                iconLabel.setPixmap(pixmap)
-                dateLable = QLabel('<font size="2"><b>{0}, {1}</b></font>'.format(item['day'], item['date']))
-                textLable = QLabel('<font size="2">{0}</font>'.format(item['text']))
-                highLable = QLabel(u'<font size="2"><b>Max:</b> {0}\u00B0 {1}</font>'.format(item['high'], data['units']['temperature']))
-                lowLable = QLabel(u'<font size="2"><b>Min:</b> {0}\u00B0 {1}</font>'.format(item['low'], data['units']['temperature']))
-                dateforecastLayout.addWidget(iconLabel)
-                dateforecastLayout.addWidget(dateLable)
-                dateforecastLayout.addWidget(textLable)
-                dateforecastLayout.addWidget(highLable)
-                dateforecastLayout.addWidget(lowLable)
-                if column < 5:
-                    row = 0
-                else:
-                    row = 1
-                forecastLayout.addLayout(dateforecastLayout, row, column % 5)
-                column = column + 1
-
-            lastupdateLabel = QLabel('<small><i>Last update at: {0}</i></small>'.format(data['timestamp']))
-
-            buttonBox = QDialogButtonBox(QDialogButtonBox.Ok, Qt.Horizontal, dialog)
-            buttonBox.accepted.connect(dialog.accept)
-
-            layout = QVBoxLayout()
-            layout.addLayout(overviewLayout)
-            layout.addLayout(forecastLayout)
-            layout.addWidget(lastupdateLabel)
-            layout.addWidget(buttonBox)
-            dialog.setLayout(layout)
-
-            dialog.show()
+            if self.overview is None:
+                self.overview = OverviewDialog(self)
+            self.overview.set_data(data, self.args.units, self.trends)
+            self.overview.show()
+            self.overview.raise_()
+            self.overview.activateWindow()
         except Exception as e:
             print(str(e))
             self.trayicon.error(e)
 
     def on_change_location(self, widget):
         print("Opening a new popup window...")
+        if self.gazetteer is None:
+            try:
+                self.gazetteer = Gazetteer()
+            except (OSError, ValueError):
+                pass
         dialog = QDialog(self)
         verticalLayout = QVBoxLayout()
         gridLayout = QGridLayout()
@@ -316,6 +849,7 @@ class MainApp(QMainWindow):
         toolButton.setText("Search")
         gridLayout.addWidget(toolButton, 0, 2, 1, 1)
         self.editSearch = QLineEdit()
+        self.editSearch.textChanged.connect(self.on_search_text_changed)
         gridLayout.addWidget(self.editSearch, 0, 1, 1, 1)
         toolButton.clicked.connect(self.search)
         verticalLayout.addLayout(gridLayout)
@@ -323,8 +857,12 @@ class MainApp(QMainWindow):
         verticalLayout.addItem(spacerItem)
         label = QLabel("Select your location:")
         verticalLayout.addWidget(label)
+        self.placesModel = QStandardItemModel()
         self.searchResults = QListView()
+        self.searchResults.setModel(self.placesModel)
         verticalLayout.addWidget(self.searchResults)
+        self.searchStatus = QLabel()
+        verticalLayout.addWidget(self.searchStatus)
         buttonBox = QDialogButtonBox()
         buttonBox.setOrientation(Qt.Horizontal)
         buttonBox.setStandardButtons(QDialogButtonBox.Cancel|QDialogButtonBox.Save)
@@ -341,6 +879,7 @@ class MainApp(QMainWindow):
         dialog.show()
 
     def on_about(self, widget):
+        import base64
         dialog = QDialog(self)
         aboutText = self.tr("""<p>A simple weather information applet.</p>
             <p>Website: <a href="https://github.com/abbarrasa/openbox">
@@ -415,118 +954,191 @@ class MainApp(QMainWindow):
 
         dialog.show()
 
-    def get_data(self):
-        yql = YQL_FORECAST_BY_WOEID % (self.args.location, self.args.units)
-        data = self.api.query(yql)
-        units = data['query']['results']['channel']['units']
-        location = data['query']['results']['channel']['location']
-        condition = data['query']['results']['channel']['item']['condition']
-        wind = data['query']['results']['channel']['wind']
-        atmosphere = data['query']['results']['channel']['atmosphere']
-        astronomy = data['query']['results']['channel']['astronomy']
-        forecast = data['query']['results']['channel']['item']['forecast']
-
-        return {
-            'current': {
-                'code': condition['code'],
-                'icon': ICON_NAMES.get(condition['code']),
-                'text': condition['text'],
-                'temp': u'{0}\u00B0 {1}'.format(condition['temp'], units['temperature']),
-            },
-            'extra': {
-                'wind': {
-                    'direction': self.conv_direction(wind['direction']),
-                    'speed': '{0} {1}'.format(wind['speed'], units['speed'])
-                },
-                'atmosphere': {
-                    'humidity': '{0}%'.format(atmosphere['humidity']),
-                    'visibility': '{0} {1}'.format(atmosphere['visibility'], units['distance']),
-                    'pressure': '{0} {1}'.format(atmosphere['pressure'], units['pressure'])
-                },
-                'astronomy': {
-                    'sunrise': u'{0:%R} \u2600 '.format(self.to_time(astronomy['sunrise'])),
-                    'sunset': u'{0:%R} \u263E '.format(self.to_time(astronomy['sunset']))
-                }
-            },
-            'forecast': forecast,
-            'location': {
-                'city': location['city'],
-                'country': location['country']
-            },
-            'timestamp': datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
-            'units': units
-        }
+    def get_data(self, offline=False):
+        return self.provider.forecast(self.args.location, offline)
 
     def refresh(self):
-        try:
-            data = self.get_data()
-            print('----------------- {0} ---------------'.format(datetime.today().strftime('%Y-%m-%d %H:%M:%S')))
-            print(data)
-            self.trayicon.update(data)
-            self.timer.start(self.args.delta * 60 * 1000)
+        self.refresh_started = perf_counter()
+        if self.client is not None:
+            self.client.refresh()
+            return
+        self.fetch('refresh', self.get_data, self.on_data, self.on_refresh_error)
+
+    def on_timer(self):
+        # Polls are skipped, not retried, while nobody is looking or
+        # there is no network to reach
+        if self.monitor.is_online() and not self.monitor.is_idle():
+            self.refresh()
+        else:
+            if self.error is not None and self.data is not None:
+                # Update the age of the data shown, or drop it when too old
+                self.show_refresh_error(self.error)
+            self.set_timer()
 
-        except Exception as e:
-            print(str(e))
-            self.trayicon.error(e)
+    def on_resume(self):
+        self.set_timer(self.scheduler.delay_after_resume())
+
+    def on_online(self):
+        if self.scheduler.failures:
+            self.refresh()
 
-    def conv_direction(self, value):
-        value = Decimal(value)
-        if 0 <= value < 22.5:
-            return u'\u2193 (N)'
-        elif 22.5 <= value < 67.5:
-            return u'\u2199 (NE)'
-        elif 67.5 <= value < 112.5:
-            return u'\u2190 (E)'
-        elif 112.5 <= value < 157.5:
-            return u'\u2196 (SE)'
-        elif 157.5 <= value < 202.5:
-            return u'\u2191 (S)'
-        elif 202.5 <= value < 247.5:
-            return u'\u2197 (SW)'
-        elif 247.5 <= value < 292.5:
-            return u'\u2192 (W)'
-        elif 292.5 <= value < 337.5:
-            return u'\u2198 (NW)'
+    def set_timer(self, delay=None):
+        if delay is None:
+            delay = self.scheduler.delay()
+        self.timer.start(int(delay * 1000))
+
+    def on_refresh_error(self, e):
+        self.stats.end()
+        self.scheduler.failed()
+        self.set_timer()
+        self.show_refresh_error(e)
+
+    def show_refresh_error(self, e):
+        self.error = e
+        if self.data is not None and self.data[0].age() < self.args.stale * 60:
+            # Keep serving the last good data, marked with its age
+            print(str(e))
+            self.trayicon.update(self.data, self.args.units, e)
         else:
-            return u'\u2193 (N)'
+            self.data = None
+            self.on_error(e)
 
-    def to_time(self, value):
-        t, p = value.split(' ')
-        h, m = map(int, t.split(':'))
-        if p.lower() == 'pm':
-            h += 12
-        return time(h, m)
+    def render(self):
+        if self.overview is not None and self.overview.isVisible():
+            self.overview.set_data(self.data, self.args.units, self.trends)
+        self.trayicon.update(self.data, self.args.units, self.error)
 
-    def search(self):
-        try:
-            yql = YQL_LOCATION_BY_TEXT % (self.editSearch.text())
-            data = self.api.query(yql)
-            ns = {}
-            count = data['query']['count']
-            if count == 1:
-                place = data['query']['results']['place']
-                self.append_place(ns, place)
-            elif count > 1:
-                for place in data['query']['results']['place']:
-                    self.append_place(ns, place)
-
-            model = QStandardItemModel()
-            for woeid, value in ns.items():
-                item = QStandardItem(value)
-                item.setData(str(woeid), Qt.UserRole)
-                model.appendRow(item)
-
-            self.searchResults.setModel(model)
+        delay = next_sun_event(self.data)
+        if delay is not None:
+            self.sunTimer.start(int(delay * 1000) + 1000)
+        else:
+            self.sunTimer.stop()
+
+    def on_sun_timer(self):
+        if self.data is not None:
+            self.render()
+
+    def on_set_units(self, units):
+        # Values are converted when rendered, the data stays as it is
+        self.args.units = units
+        if self.data is not None:
+            self.render()
+
+    def on_data(self, data):
+        self.data = data
+        self.error = None
+        with self.stats.timer('render'):
+            self.render()
+        if self.refresh_started is not None:
+            self.stats.add('total', perf_counter() - self.refresh_started)
+            self.refresh_started = None
+        self.stats.end()
+        if self.args.stats:
+            print(self.stats.report(), file=sys.stderr)
+        if self.client is None:
+            self.scheduler.succeeded(data)
+            self.set_timer()
+        self.notifier.weather(data)
+        if self.history is not None:
+            self.fetch('history', lambda: self.load_history(data), self.on_trends, print)
+
+    def load_history(self, data):
+        # Runs in a worker, SQLite may wait for other instances. Clients
+        # only read what their daemon records.
+        if self.client is None:
+            self.history.add(data)
+        return self.history.trends(data)
+
+    def on_trends(self, trends):
+        self.trends = trends
+        if self.data is not None and self.overview is not None and self.overview.isVisible():
+            self.overview.set_data(self.data, self.args.units, self.trends)
+
+    def get_search_key(self):
+        return ' '.join(self.editSearch.text().lower().split())
+
+    def on_search_text_changed(self, text):
+        # Whatever is in flight is for an older text
+        self.cancel('search')
+        self.searchTimer.stop()
+        key = self.get_search_key()
+        if not key:
+            self.show_places([])
+            return
+
+        places = self.places.get(key)
+        if places is not None:
+            self.show_places(places)
+            return
+
+        # Places of the offline gazetteer, or else the results of the
+        # longest searched prefix, are only shown until the query answers:
+        # the gazetteer may hold few places and the API searches full
+        # text, not prefixes
+        places = None
+        if self.gazetteer is not None:
+            places = [[place.woeid, place.label] for place in self.gazetteer.search(key, PLACES_LIMIT)] or None
+        if places is None:
+            for end in range(len(key) - 1, 0, -1):
+                places = self.places.get(key[:end])
+                if places is not None:
+                    places = [place for place in places if key in place[1].lower()]
+                    break
+        if places is not None:
+            self.show_places(places)
+
+        self.searchTimer.start(SEARCH_DELAY)
 
-        except Exception as e:
-            print(str(e))
-            self.trayicon.error(e)
+    def search(self):
+        self.searchTimer.stop()
+        key = self.get_search_key()
+        if not key:
+            return
+        places = self.places.get(key)
+        if places is not None:
+            self.show_places(places)
+            return
+
+        yql = YQL_LOCATION_BY_TEXT % (PLACES_LIMIT, yql_quote(self.editSearch.text().strip()))
+        self.fetch('search', lambda: self.get_places(yql), lambda places: self.on_places(key, places),
+                   lambda e: self.on_search_error(key, e))
+
+    def get_places(self, yql):
+        data = self.places_api.query(yql, cached=False)
+        places = []
+        count = data['query']['count']
+        if count == 1:
+            place = data['query']['results']['place']
+            self.append_place(places, place)
+        elif count > 1:
+            for place in data['query']['results']['place']:
+                self.append_place(places, place)
+        return places
+
+    def on_places(self, key, places):
+        self.places.put(key, places)
+        if key == self.get_search_key():
+            self.show_places(places)
+
+    def on_search_error(self, key, e):
+        # Shown in the dialog only, the weather data is still good
+        if key == self.get_search_key():
+            self.show_places([])
+            self.searchStatus.setText('<i>Search failed: {0}</i>'.format(e))
+
+    def show_places(self, places):
+        self.searchStatus.clear()
+        self.placesModel.clear()
+        for woeid, value in places:
+            item = QStandardItem(value)
+            item.setData(str(woeid), Qt.UserRole)
+            self.placesModel.appendRow(item)
 
     def save_location(self, dialog):
         selected = self.searchResults.selectedIndexes()
         if len(selected) == 1:
             woeid = selected[0].data(Qt.UserRole)
-            self.args.location = woeid
+            self.args.location[0] = woeid
             self.refresh()
 
         dialog.close()
@@ -534,15 +1146,16 @@ class MainApp(QMainWindow):
     def append_place(self, list, place):
         value = '{0}, {1}, {2}, {3}'.format(place['name'], place['admin2'], place['admin1'], place['country'])
         woeid = place['woeid']
-        list[woeid] = value
+        list.append([woeid, value])
                     
 
 if __name__ == "__main__":
-    import sys
     try:
         args = parse_arguments()
+        startup_phase('parse arguments')
         app = QApplication(sys.argv)
         QApplication.setQuitOnLastWindowClosed(False)
+        startup_phase('QApplication')
 
         trayIcon = MainApp(args)
 
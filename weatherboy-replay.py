@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# License: GPLv3
+# Website: https://github.com/abbarrasa/openbox
+#
+# A local stand-in for the Yahoo! Weather YQL API. It replays recorded
+# weather channels (one JSON file per WOEID and units, named
+# <woeid>-<c|f>.json) so weatherboy and weatherboy-qt can be tested and
+# benchmarked offline. With --record, unknown locations are fetched
+# from the real API and saved as new fixtures. Like a real web server,
+# it keeps connections alive, gzips responses and answers conditional
+# requests with 304 Not Modified.
+#
+# Example of use: python3 weatherboy-replay.py -p 8080 &
+#                 python3 weatherboy-qt.py -l 766273 44418 --api-url http://localhost:8080/v1/public/yql
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+import urllib.parse
+import urllib.request
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'yahoo')
+PUBLIC_API_URL = 'http://query.yahooapis.com/v1/public/yql'
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Replay server for the Yahoo! Weather YQL API',
+                            epilog='Free software under GPL license.'
+                            'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
+    parser.add_argument('-p', '--port',
+                        default='8080',
+                        type=int,
+                        metavar='N',
+                        help='port to listen on')
+    parser.add_argument('-f', '--fixtures',
+                        default=FIXTURES_DIR,
+                        metavar='DIR',
+                        help='directory of recorded weather channels')
+    parser.add_argument('--delay',
+                        default='0',
+                        type=int,
+                        metavar='MS',
+                        help='latency in milliseconds added to every response')
+    parser.add_argument('--record', action='store_true', default=False,
+                        help='fetch and save locations without a fixture from the real API')
+    parser.add_argument('--upstream',
+                        default=PUBLIC_API_URL,
+                        metavar='URL',
+                        help='API used to record new fixtures')
+    args = parser.parse_args()
+    return args
+
+
+class Fixtures(object):
+    def __init__(self, directory, upstream=None):
+        self.directory = directory
+        self.upstream = upstream
+
+    def path(self, woeid, units):
+        return os.path.join(self.directory, '{0}-{1}.json'.format(woeid, units))
+
+    def load(self, woeid, units):
+        try:
+            with open(self.path(woeid, units), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def record(self, woeids, units):
+        yql = "select * from weather.forecast where woeid in (%s) and u='%s'" % (
+            ','.join("'%s'" % woeid for woeid in woeids), units)
+        url = self.upstream + '?' + urllib.parse.urlencode({'q': yql, 'format': 'json'})
+        data = json.loads(urllib.request.urlopen(url, timeout=30).read().decode('utf-8'))
+        channels = data['query']['results']['channel']
+        if not isinstance(channels, list):
+            channels = [channels]
+
+        os.makedirs(self.directory, exist_ok=True)
+        for woeid, channel in zip(woeids, channels):
+            with open(self.path(woeid, units), 'w', encoding='utf-8') as f:
+                json.dump(channel, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+    def query(self, yql):
+        """Answers a weather.forecast YQL query the way the API does."""
+        woeids = re.findall(r"\d+", ''.join(re.findall(r"woeid\s*(?:=\s*'\d+'|in\s*\([^)]*\))", yql)))
+        match = re.search(r"u\s*=\s*'([cf])'", yql)
+        units = match.group(1) if match else 'f'
+
+        missing = [woeid for woeid in woeids if self.load(woeid, units) is None]
+        if missing and self.upstream:
+            self.record(missing, units)
+
+        channels = [channel for channel in (self.load(woeid, units) for woeid in woeids) if channel is not None]
+        if not channels:
+            results = None
+        elif len(channels) == 1:
+            results = {'channel': channels[0]}
+        else:
+            results = {'channel': channels}
+
+        return {
+            'query': {
+                'count': len(channels),
+                'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'lang': 'en-US',
+                'results': results
+            }
+        }
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if 'q' not in params:
+            self.send_error(400, 'Missing YQL query')
+            return
+
+        if self.server.delay:
+            time.sleep(self.server.delay / 1000.0)
+
+        try:
+            data = self.server.fixtures.query(params['q'][0])
+        except Exception as e:
+            self.send_error(502, str(e))
+            return
+
+        # The creation time changes on every query, the results do not
+        etag = '"{0}"'.format(hashlib.sha1(json.dumps(data['query']['results'], sort_keys=True).encode('utf-8')).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    try:
+        args = parse_arguments()
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), ReplayHandler)
+        server.fixtures = Fixtures(args.fixtures, args.upstream if args.record else None)
+        server.delay = args.delay
+        print('Replaying {0} on http://127.0.0.1:{1}/v1/public/yql'.format(args.fixtures, args.port))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -29,21 +29,35 @@
 # on <https://github.com/decayofmind/weatherboy>
 #
 # Example of use: python weatherboy.py -l 22664159 -u c -d 30 -a
+#                 python weatherboy.py -l 22664159 766273 -u c -d 30 -a
 
 from argparse import ArgumentParser
 import gobject
 import gtk
-import json
-import urllib
-import urllib2
+import socket
+import threading
 import webbrowser
-from decimal import Decimal
-from datetime import datetime, time
+from weatherboy_core import (PUBLIC_API_URL, PROVIDERS, SNAPSHOT_SOCKET,
+    UNITS, HistoryStore, LRUCache, RefreshScheduler, ResponseCache, YahooAPI,
+    conv_direction, decode_snapshot, format_age, format_percent, format_quantity,
+    format_temp, format_trend, next_sun_event, resolve_locations)
+
+try:
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+except ImportError:
+    dbus = None
 
 # Yahoo! Weather YQL API
 WEATHER_WEBSITE = 'https://www.yahoo.com/news/weather'
-PUBLIC_API_URL  = 'http://query.yahooapis.com/v1/public/yql'
-YQL_FORECAST_BY_WOEID = "select * from weather.forecast where woeid='%s' and u='%s'"
+
+# Session and network state through D-Bus
+LOGIN1_SERVICE = 'org.freedesktop.login1'
+LOGIN1_PATH = '/org/freedesktop/login1'
+LOGIN1_MANAGER = 'org.freedesktop.login1.Manager'
+NM_SERVICE = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_STATE_CONNECTED_GLOBAL = 70
 
 # Icon name by Yahoo! Weather code
 ICON_NAMES = {
@@ -104,128 +118,398 @@ def parse_arguments():
                             epilog='Free software under GPL license.'
                             'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
     parser.add_argument('-l', '--location',
-                        required=True,
+                        default=[],
+                        nargs='+',
                         metavar='WOEID',
-                        help='location WOEID (more on https://developer.yahoo.com/weather/)')
+                        help='location WOEIDs or names in the offline gazetteer, one tray icon each (more on https://developer.yahoo.com/weather/)')
     parser.add_argument('-u', '--units',
                         choices=['c', 'f'],
                         default='c',
                         metavar='c|f',
-                        help='units to display')
+                        help='units to display, also switched from the menu')
     parser.add_argument('-d', '--delta',
                         default='10',
                         type=int,
                         metavar='N',
-                        help='timeout in minutes between next weather data query')
+                        help='minimum timeout in minutes between weather data queries; a longer ttl of the provider takes precedence')
+    parser.add_argument('-b', '--backoff',
+                        default='60',
+                        type=int,
+                        metavar='N',
+                        help='maximum timeout in minutes between retries after a connection error')
+    parser.add_argument('-t', '--ttl',
+                        default='5',
+                        type=int,
+                        metavar='N',
+                        help='time in minutes a cached weather data query is still valid')
+    parser.add_argument('-S', '--stale',
+                        default='120',
+                        type=int,
+                        metavar='N',
+                        help='time in minutes the last good weather data is still shown after errors')
+    parser.add_argument('-H', '--history',
+                        default='30',
+                        type=int,
+                        metavar='N',
+                        help='days of weather history kept for trends, 0 to keep none')
+    parser.add_argument('-p', '--provider',
+                        choices=sorted(PROVIDERS),
+                        default='yahoo',
+                        help='weather data provider')
+    parser.add_argument('--api-url',
+                        default=PUBLIC_API_URL,
+                        metavar='URL',
+                        help='weather API endpoint (e.g. a local weatherboy-replay server)')
+    parser.add_argument('-T', '--timeout',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='timeout in seconds for a weather data query')
     parser.add_argument('-a', '--advanced', action='store_true', default=False, help='Advanced tooltip')
+    parser.add_argument('-c', '--client', action='store_true', default=False,
+                        help='only show the weather published by weatherboyd')
+    parser.add_argument('-s', '--socket',
+                        default=SNAPSHOT_SOCKET,
+                        metavar='PATH',
+                        help='Unix socket of weatherboyd')
   
     args = parser.parse_args()
+    if not args.client and not args.location:
+        parser.error('argument -l/--location is required')
+    try:
+        args.location = resolve_locations(args.location)
+    except Exception as e:
+        parser.error(str(e))
     return args
 
-  
-class YahooAPI(object):
-    def __init__(self):
-        self.website = WEATHER_WEBSITE
-        
-    def yql_query(self, yql):
+
+class SessionMonitor(object):
+    """Follows suspend/resume, idleness and network state through logind
+    and NetworkManager. Without D-Bus the session is always considered
+    active and online."""
+    def __init__(self, on_resume, on_online):
+        self.bus = None
+        if dbus is None:
+            return
+        try:
+            DBusGMainLoop(set_as_default=True)
+            self.bus = dbus.SystemBus()
+            self.bus.add_signal_receiver(
+                lambda sleeping: sleeping or on_resume(),
+                'PrepareForSleep', LOGIN1_MANAGER, LOGIN1_SERVICE, LOGIN1_PATH)
+            self.bus.add_signal_receiver(
+                lambda state: state == NM_STATE_CONNECTED_GLOBAL and on_online(),
+                'StateChanged', NM_SERVICE, NM_SERVICE, NM_PATH)
+        except dbus.DBusException:
+            self.bus = None
+
+    def get_property(self, service, path, interface, name, default):
+        if self.bus is None:
+            return default
         try:
-            url = PUBLIC_API_URL + '?' + urllib.urlencode({'q': yql, 'format': 'json'})
-            response = urllib2.urlopen(url).read()
-            data = json.loads(response)
-            return data	
-        except:
-            raise Exception("Connection error!")
-
-	  
+            proxy = self.bus.get_object(service, path)
+            return proxy.Get(interface, name, dbus_interface=dbus.PROPERTIES_IFACE)
+        except dbus.DBusException:
+            return default
+
+    def is_online(self):
+        state = self.get_property(NM_SERVICE, NM_PATH, NM_SERVICE, 'State', NM_STATE_CONNECTED_GLOBAL)
+        return state == NM_STATE_CONNECTED_GLOBAL
+
+    def is_idle(self):
+        return bool(self.get_property(LOGIN1_SERVICE, LOGIN1_PATH, LOGIN1_MANAGER, 'IdleHint', False))
+
+
+class IconCache(object):
+    """Pixbufs of theme icons by name and size. load_icon walks the theme
+    directories on disk, so its pixbufs are kept until the icon theme
+    emits 'changed'."""
+    def __init__(self, maxsize=128):
+        self.cache = LRUCache(maxsize)
+        self.theme = gtk.icon_theme_get_default()
+        self.theme.connect('changed', lambda theme: self.cache.clear())
+
+    def pixbuf(self, name, size):
+        pixbuf = self.cache.get((name, size))
+        if pixbuf is None:
+            try:
+                pixbuf = self.theme.load_icon(name, size, 0)
+            except gobject.GError:
+                return None
+            self.cache.put((name, size), pixbuf)
+        return pixbuf
+
+
+class SnapshotClient(object):
+    """weatherboyd client watched by the GTK main loop. While the daemon
+    is not available it tries to connect again every RETRY seconds."""
+
+    # Seconds between connection attempts
+    RETRY = 10
+
+    def __init__(self, path, on_snapshot, on_error):
+        self.path = path
+        self.on_snapshot = on_snapshot
+        self.on_error = on_error
+        self.sock = None
+        self.buffer = ''
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            self.disconnected()
+            return False
+
+        self.sock = sock
+        self.buffer = ''
+        gobject.io_add_watch(sock, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, self.on_io)
+        return False
+
+    def disconnected(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.on_error(Exception("Weather daemon not available!"))
+        gobject.timeout_add_seconds(self.RETRY, self.connect)
+
+    def refresh(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall('refresh\n')
+            except socket.error:
+                pass
+
+    def on_io(self, source, condition):
+        data = ''
+        if condition & gobject.IO_IN:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                pass
+        if not data:
+            self.disconnected()
+            return False
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                records, error = decode_snapshot(line)
+            except (ValueError, KeyError, TypeError):
+                continue
+            if error is not None:
+                self.on_error(Exception(error))
+            else:
+                self.on_snapshot(records)
+        return True
+
+
 class MainApp:
     def __init__(self, args):
         self.args = args
-        self.weather = None
-        self.tooltip = None
-        self.tray = gtk.StatusIcon()
-        self.tray.connect('popup-menu', self.on_right_click)
-        self.tray.connect('activate', self.on_left_click)
-        self.tray.set_has_tooltip(True)
-        self.tray.connect('query-tooltip', self.on_tooltip_advanced)	
-        self.api = YahooAPI()
+        self.weather = []
+        self.error = None
+        self.tooltips = []
+        self.markups = []
+        self.trays = []
+        self.icons = IconCache()
+        self.history = HistoryStore(retention=args.history) if args.history > 0 else None
+        self.trends = {}
+        self.set_trays(max(1, len(args.location)))
+        self.sun_timer_id = -1
+        self.client = None
+        if args.client:
+            # Only render what the daemon publishes
+            self.client = SnapshotClient(args.socket, self.show_weather, self.show_error)
+            gobject.idle_add(self.client.connect)
+            return
+
+        self.api = YahooAPI(ResponseCache(args.ttl), args.timeout, args.api_url)
+        self.provider = PROVIDERS[args.provider](self.api)
+        self.scheduler = RefreshScheduler(args.delta, args.backoff)
+        self.monitor = SessionMonitor(self.on_resume, self.on_online)
         self.timer_id = -1
-        self.update_tray()
-        self.set_timer()	
-
-    def get_data(self):
-        yql = YQL_FORECAST_BY_WOEID % (self.args.location, self.args.units)
-        data = self.api.yql_query(yql)
-        units = data['query']['results']['channel']['units']
-        location = data['query']['results']['channel']['location']
-        condition = data['query']['results']['channel']['item']['condition']
-        wind = data['query']['results']['channel']['wind']
-        atmosphere = data['query']['results']['channel']['atmosphere']
-        astronomy = data['query']['results']['channel']['astronomy']
-        forecast = data['query']['results']['channel']['item']['forecast']
-
-        return {
-            'current': {
-                'code': condition['code'],
-                'icon': ICON_NAMES.get(condition['code']), 
-                'text': condition['text'],
-                'temp': u'{0}\u00B0 {1}'.format(condition['temp'], units['temperature']),
-            },
-            'extra': {
-                'wind': {
-                    'direction': self.conv_direction(wind['direction']),
-                    'speed': '{0} {1}'.format(wind['speed'], units['speed'])
-                },
-                'atmosphere': {
-                    'humidity': '{0}%'.format(atmosphere['humidity']),
-                    'visibility': '{0} {1}'.format(atmosphere['visibility'], units['distance']),
-                    'pressure': '{0} {1}'.format(atmosphere['pressure'], units['pressure'])
-                },
-                'astronomy': {
-                    'sunrise': u'\u2600 {0:%R}'.format(self.to_time(astronomy['sunrise'])),
-                    'sunset': u'\u263E {0:%R}'.format(self.to_time(astronomy['sunset']))                    
-                }
-            },
-            'forecast': forecast,
-            'location': {
-                'city': location['city'],
-                'country': location['country']
-            },
-            'timeStamp': datetime.today().strftime('%Y-%m-%d %H:%M')
-        }		
-
-    def update_tray(self):
+        # Paint the last good data before the main loop starts and
+        # revalidate it once the icon is already on screen.
+        self.update_tray(offline=True)
+        gobject.idle_add(self.on_refresh, None)
+
+    def get_data(self, offline=False):
+        return self.provider.forecast(self.args.location, offline)
+
+    def get_extra(self, weather):
+        units = self.args.units
+        return [
+            ('wind', [
+                ('direction', conv_direction(weather.wind_direction)),
+                ('speed', format_quantity(weather.wind_speed, 'speed', units))
+            ]),
+            ('atmosphere', [
+                ('humidity', format_percent(weather.humidity)),
+                ('pressure', format_quantity(weather.pressure, 'pressure', units)),
+                ('visibility', format_quantity(weather.visibility, 'distance', units))
+            ]),
+            ('astronomy', [
+                ('sunrise', u'\u2600 {0:%R}'.format(weather.sunrise)),
+                ('sunset', u'\u263E {0:%R}'.format(weather.sunset))
+            ])
+        ] + self.get_trends(weather)
+
+    def get_trends(self, weather):
+        rows = [(label, format_trend(trend, self.args.units)) for label, trend in self.trends.get(weather.woeid, [])]
+        return [('trend', rows)] if rows else []
+
+    def load_history(self, weather):
+        # Runs in a thread, SQLite may wait for other instances. Clients
+        # only read what their daemon records.
+        if self.client is None:
+            self.history.add(weather)
+        gobject.idle_add(self.on_trends, weather, self.history.trends(weather))
+
+    def on_trends(self, weather, trends):
+        if weather is self.weather:
+            self.trends = trends
+            self.update_tooltips(None if self.error is None else str(self.error))
+        return False
+
+    def set_trays(self, count):
+        """Shows a tray icon for each of the first count locations."""
+        while len(self.trays) < count:
+            tray = gtk.StatusIcon()
+            tray.connect('popup-menu', self.on_right_click)
+            tray.connect('activate', self.on_left_click)
+            tray.set_has_tooltip(True)
+            tray.connect('query-tooltip', self.on_tooltip_advanced)
+            self.trays.append(tray)
+            self.tooltips.append(None)
+            self.markups.append(None)
+        for i, tray in enumerate(self.trays):
+            tray.set_visible(i < count)
+
+    def update_tray(self, offline=False):
         try:
-            self.weather = self.get_data()
-            self.tray.set_from_icon_name(self.weather['current']['icon'])
+            weather = self.get_data(offline)
         except Exception as e:
-            self.tray.set_tooltip_text(str(e))
-            self.tray.set_from_stock('gtk-dialog-error')
-	  
-        return True	
-	
+            if not offline:
+                self.scheduler.failed()
+                self.show_error(e)
+            return True
+
+        if not offline:
+            self.scheduler.succeeded(weather)
+        self.show_weather(weather)
+        return True
+
+    def show_weather(self, weather):
+        self.weather = weather
+        self.error = None
+        self.set_trays(len(weather))
+        self.update_icons()
+        self.update_tooltips()
+        if self.history is not None:
+            thread = threading.Thread(target=self.load_history, args=(weather,))
+            thread.daemon = True
+            thread.start()
+
+    def update_icons(self):
+        for tray, item in zip(self.trays, self.weather):
+            tray.set_from_icon_name(item.icon(ICON_NAMES))
+
+        # Day and night icons switch when the sun rises or sets, not on
+        # the next poll
+        if self.sun_timer_id > 0:
+            gobject.source_remove(self.sun_timer_id)
+            self.sun_timer_id = -1
+        delay = next_sun_event(self.weather)
+        if delay is not None:
+            self.sun_timer_id = gobject.timeout_add_seconds(max(1, int(delay) + 1), self.on_sun_event)
+
+    def on_sun_event(self):
+        self.sun_timer_id = -1
+        if self.weather:
+            self.update_icons()
+            self.update_tooltips(None if self.error is None else str(self.error))
+        return False
+
+    def show_error(self, e):
+        self.error = e
+        if self.weather and self.weather[0].age() < self.args.stale * 60:
+            # Keep serving the last good data, marked with its age
+            self.update_tooltips(str(e))
+            return
+
+        self.weather = []
+        self.update_tooltips(str(e))
+        for tray in self.trays:
+            tray.set_from_stock('gtk-dialog-error')
+
     def on_refresh(self, widget):
+        if self.client is not None:
+            self.client.refresh()
+            return False
+
         self.update_tray()
         self.set_timer()
+        return False
+
+    def on_timer(self):
+        # Polls are skipped, not retried, while nobody is looking or
+        # there is no network to reach
+        if self.monitor.is_online() and not self.monitor.is_idle():
+            self.update_tray()
+        elif self.error is not None and self.weather:
+            # Update the age of the data shown, or drop it when too old
+            self.show_error(self.error)
+        self.set_timer()
+        return False
+
+    def on_resume(self):
+        self.set_timer(self.scheduler.delay_after_resume())
+
+    def on_online(self):
+        if self.scheduler.failures:
+            self.on_refresh(None)
 
     def on_right_click(self, icon, event_button, event_time):
         menu = gtk.Menu()
         refresh = gtk.MenuItem('Refresh')
         refresh.show()
         refresh.connect('activate', self.on_refresh)
+        menu.append(refresh)
+        group = None
+        for units in sorted(UNITS):
+            item = gtk.RadioMenuItem(group, u'\u00B0{0}'.format(UNITS[units]['temperature']))
+            group = item
+            item.set_active(units == self.args.units)
+            item.connect('toggled', self.on_set_units, units)
+            item.show()
+            menu.append(item)
         quit = gtk.MenuItem('Quit')
         quit.show()
         quit.connect('activate', gtk.main_quit)
-        menu.append(refresh)
         menu.append(quit)
         menu.popup(None, None, gtk.status_icon_position_menu,
-                   event_button, event_time, self.tray)
+                   event_button, event_time, icon)
+
+    def on_set_units(self, item, units):
+        # Values are converted when rendered, the data stays as it is
+        if not item.get_active() or units == self.args.units:
+            return
+        self.args.units = units
+        if self.weather:
+            self.update_tooltips(None if self.error is None else str(self.error))
 
     def on_left_click(self, widget):
-        webbrowser.open(self.api.website)
+        webbrowser.open(WEATHER_WEBSITE)
 
-    def set_timer(self):
+    def set_timer(self, delay=None):
+        if delay is None:
+            delay = self.scheduler.delay()
         self.remove_timer()
-        self.timer_id = gobject.timeout_add_seconds(self.args.delta * 60, self.update_tray)
+        self.timer_id = gobject.timeout_add_seconds(max(1, int(delay)), self.on_timer)
 
     def remove_timer(self):
         if self.timer_id > 0:
@@ -233,95 +517,100 @@ class MainApp:
             self.timer_id = -1	
 			
     def on_tooltip_advanced(self, widget, x, y, keyboard_mode, tooltip):
-        if not self.args.advanced:
-            tooltip_text = '{0} / {1}'.format(self.weather['current_temp'], self.weather['current_condition'])
-            tooltip.set_tooltip_markup(tooltip_text)
+        # Tooltips are built on every data update, hovering only shows them
+        index = self.trays.index(widget)
+        if self.tooltips[index] is not None:
+            tooltip.set_custom(self.tooltips[index])
+        elif self.markups[index] is not None:
+            tooltip.set_markup(self.markups[index])
         else:
-            tooltip_text = '{0}\n{1}'.format(self.weather['current']['temp'], self.weather['current']['text'])		
-            vbox = gtk.VBox()
-            header = gtk.Label()
-            header.set_markup(
-                              '<span size="12000"><b>{0}, {1}</b></span>'.format(self.weather['location']['city'], self.weather['location']['country']))
-            header.set_alignment(0.9, 0.5)
-            footer = gtk.Label()
-            footer.set_markup('<small><i>Last checked: {0}</i></small>'.format(self.weather['timeStamp']))
-            hbox = gtk.HBox()
-            now_icon = self.get_image_by_icon(self.weather['current']['icon'])
-            now_label = gtk.Label()
-            now_label.set_markup('<b>{0}</b>'.format(tooltip_text))
-            now_label.set_padding(5, 5)
-            table = gtk.Table(columns=2, homogeneous=False)
-            u = 0
-            l = 1
-            for k, v in self.weather['extra'].items():
-                h_label = gtk.Label()
-                h_label.set_markup('<b>{0}</b>'.format(k))
-                h_label.set_alignment(0.0, 0.5)
-                h_label.set_padding(5, 5)
-                table.attach(h_label, 0, 1, u, l)
-                for i, j in sorted(v.items()):
-                    u += 1
-                    l += 1
-                    k_label = gtk.Label(i)
-                    k_label.set_alignment(0.0, 0.5)
-                    v_label = gtk.Label(j)
-                    v_label.set_alignment(0.0, 0.5)
-                    table.attach(k_label, 0, 1, u, l)
-                    table.attach(v_label, 1, 2, u, l)
-                    u += 1
-                    l += 1
-
-            hbox.pack_start(now_icon, False, False, 0)
-            hbox.pack_start(now_label, False, False, 0)
-            vbox.pack_start(header, True, False, 0)
-            vbox.pack_start(hbox, False, False, 0)
-            vbox.pack_start(table, False, False, 0)
-            vbox.pack_start(gtk.HSeparator(), False, False, 5)            
-            vbox.pack_start(footer, False, False, 3)
-            vbox.show_all()
-            tooltip.set_custom(vbox)
-		
-            return True
-	
+            return False
+
+        return True
+
+    def update_tooltips(self, error=None):
+        if error is not None and not self.weather:
+            self.markups = [error] * len(self.trays)
+            self.tooltips = [None] * len(self.trays)
+        elif not self.args.advanced:
+            self.markups = [self.build_markup(weather, error) for weather in self.weather]
+        else:
+            self.tooltips = [self.build_tooltip(weather, error) for weather in self.weather]
+
+    def get_stale_note(self, weather, error):
+        return u'{0} Showing data from {1} ago.'.format(error, format_age(weather.age()))
+
+    def build_markup(self, weather, error=None):
+        markup = u'{0} / {1}'.format(format_temp(weather.temp, self.args.units), weather.text)
+        if error is not None:
+            markup += u'\n<i>{0}</i>'.format(self.get_stale_note(weather, error))
+        return markup
+
+    def build_tooltip(self, weather, error=None):
+        tooltip_text = u'{0}\n{1}'.format(format_temp(weather.temp, self.args.units), weather.text)
+        vbox = gtk.VBox()
+        header = gtk.Label()
+        header.set_markup(
+                          u'<span size="12000"><b>{0}, {1}</b></span>'.format(weather.city, weather.country))
+        header.set_alignment(0.9, 0.5)
+        footer = gtk.Label()
+        footer_text = 'Last checked: {0}'.format(weather.checked.strftime('%Y-%m-%d %H:%M'))
+        if error is not None:
+            footer_text += '\n' + self.get_stale_note(weather, error)
+        footer.set_markup(u'<small><i>{0}</i></small>'.format(footer_text))
+        hbox = gtk.HBox()
+        now_icon = self.get_image_by_icon(weather.icon(ICON_NAMES))
+        now_label = gtk.Label()
+        now_label.set_markup(u'<b>{0}</b>'.format(tooltip_text))
+        now_label.set_padding(5, 5)
+        table = gtk.Table(columns=2, homogeneous=False)
+        u = 0
+        l = 1
+        for k, v in self.get_extra(weather):
+            h_label = gtk.Label()
+            h_label.set_markup('<b>{0}</b>'.format(k))
+            h_label.set_alignment(0.0, 0.5)
+            h_label.set_padding(5, 5)
+            table.attach(h_label, 0, 1, u, l)
+            for i, j in v:
+                u += 1
+                l += 1
+                k_label = gtk.Label(i)
+                k_label.set_alignment(0.0, 0.5)
+                v_label = gtk.Label(j)
+                v_label.set_alignment(0.0, 0.5)
+                table.attach(k_label, 0, 1, u, l)
+                table.attach(v_label, 1, 2, u, l)
+                u += 1
+                l += 1
+
+        hbox.pack_start(now_icon, False, False, 0)
+        hbox.pack_start(now_label, False, False, 0)
+        vbox.pack_start(header, True, False, 0)
+        vbox.pack_start(hbox, False, False, 0)
+        vbox.pack_start(table, False, False, 0)
+        vbox.pack_start(gtk.HSeparator(), False, False, 5)
+        vbox.pack_start(footer, False, False, 3)
+        vbox.show_all()
+        return vbox
+
     def get_image_by_icon(self, icon):
         image = gtk.Image()
         image.set_padding(0, 5)
         image.set_pixel_size(48)
-        image.set_from_icon_name(icon, 48)
-        return image
-	  
-    def conv_direction(self, value):
-        value = Decimal(value)
-        if 0 <= value < 22.5:
-            return u'\u2193 (N)'
-        elif 22.5 <= value < 67.5:
-            return u'\u2199 (NE)'
-        elif 67.5 <= value < 112.5:
-            return u'\u2190 (E)'
-        elif 112.5 <= value < 157.5:
-            return u'\u2196 (SE)'
-        elif 157.5 <= value < 202.5:
-            return u'\u2191 (S)'
-        elif 202.5 <= value < 247.5:
-            return u'\u2197 (SW)'
-        elif 247.5 <= value < 292.5:
-            return u'\u2192 (W)'
-        elif 292.5 <= value < 337.5:
-            return u'\u2198 (NW)'
+        pixbuf = self.icons.pixbuf(icon, 48)
+        if pixbuf is not None:
+            image.set_from_pixbuf(pixbuf)
         else:
-            return u'\u2193 (N)'
-
-    def  to_time(self, value):
-        t, p = value.split(' ')
-        h, m = map(int, t.split(':'))
-        if p.lower() == 'pm':
-            h +=12
-        return time(h, m)
-	
+            image.set_from_icon_name(icon, 48)
+        return image
+
 
 if __name__ == "__main__":
     try:
         args = parse_arguments()
+        # History is read and written by threads while the main loop waits
+        gobject.threads_init()
         MainApp(args)
         gtk.main()
     except KeyboardInterrupt:
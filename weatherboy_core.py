@@ -0,0 +1,1274 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# License: GPLv3
+# Website: https://github.com/abbarrasa/openbox
+#
+# Weather data layer shared by weatherboy (Python 2, GTK) and
+# weatherboy-qt (Python 3, Qt5). Keep it compatible with both.
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import random
+import re
+import struct
+import tempfile
+import threading
+import time as systime
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from datetime import date, datetime, time, timedelta
+
+# Yahoo! Weather YQL API
+PUBLIC_API_URL = 'http://query.yahooapis.com/v1/public/yql'
+YQL_FORECAST_BY_WOEID = "select * from weather.forecast where woeid in (%s) and u='%s'"
+# The link of a forecast ends with the WOEID of its location
+LINK_WOEID = re.compile(r'-(\d+)/?$')
+
+# Unix socket where weatherboyd publishes its snapshots. Outside of the
+# runtime directory of the user its name is per user, so nobody else can
+# take it first.
+if 'XDG_RUNTIME_DIR' in os.environ:
+    SNAPSHOT_SOCKET = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'weatherboy.sock')
+else:
+    SNAPSHOT_SOCKET = os.path.join(tempfile.gettempdir(), 'weatherboy-{0}.sock'.format(os.getuid()))
+
+# Unit labels by unit system
+UNITS = {
+    'c': {'temperature': 'C', 'speed': 'km/h', 'distance': 'km', 'pressure': 'mb'},
+    'f': {'temperature': 'F', 'speed': 'mph', 'distance': 'mi', 'pressure': 'in'}
+}
+
+# Weather records keep their values in the units of this system and
+# convert them when rendered, so one response serves both systems
+CANONICAL_UNITS = 'c'
+
+# (factor, offset) from the canonical unit of every quantity to the
+# one of the other system
+CONVERSIONS = {
+    'temperature': (1.8, 32),
+    'speed': (1 / 1.609344, 0),
+    'distance': (1 / 1.609344, 0),
+    'pressure': (0.0295299830714, 0)
+}
+
+# Shown for the values a response does not have
+NOT_AVAILABLE = 'n/a'
+
+# Decimals shown by unit
+PRECISION = {'C': 0, 'F': 0, 'km/h': 1, 'mph': 1, 'km': 1, 'mi': 1, 'mb': 0, 'in': 2}
+
+# Wind direction, as the arrow the wind blows to, by octant
+DIRECTIONS = (u'\u2193 (N)', u'\u2199 (NE)', u'\u2190 (E)', u'\u2196 (SE)',
+              u'\u2191 (S)', u'\u2197 (SW)', u'\u2192 (W)', u'\u2198 (NW)')
+
+# Phases of a refresh, in order, as timed by RefreshStats
+REFRESH_PHASES = ('connect', 'request', 'transfer', 'decode', 'parse', 'render', 'total')
+
+# Python 2 has no perf_counter
+clock = getattr(systime, 'perf_counter', systime.time)
+
+# Cached responses, shared by weatherboy and weatherboy-qt
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'weatherboy')
+
+# Persistent data: the offline place index, built by weatherboy-gazetteer,
+# and the history of observations
+DATA_DIR = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')), 'weatherboy')
+GAZETTEER_PATH = os.path.join(DATA_DIR, 'gazetteer.idx')
+HISTORY_PATH = os.path.join(DATA_DIR, 'history.sqlite')
+
+# Trends shown from the history: label, seconds and buckets
+TRENDS = (('24 h', 24 * 3600, 24), ('7 d', 7 * 24 * 3600, 28))
+
+# Levels of a sparkline
+SPARKS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+# Position of the sun: epoch of the sunrise equation, obliquity of the
+# ecliptic and altitude of the centre of the sun at sunrise and sunset,
+# below the horizon by refraction and its own radius
+J2000 = datetime(2000, 1, 1, 12)
+OBLIQUITY = math.radians(23.4397)
+SUNRISE_ALTITUDE = math.radians(-0.833)
+
+# Months of the dates of the API
+MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+# Night variants of the icons of a clear or cloudy sky
+NIGHT_ICONS = {
+    'weather-clear': 'weather-clear-night',
+    'weather-few-clouds': 'weather-few-clouds-night',
+    'weather-clouds': 'weather-clouds-night'
+}
+DAY_ICONS = dict((night, day) for day, night in NIGHT_ICONS.items())
+
+
+class LRUCache(object):
+    """A mapping that keeps only its maxsize most recently used items."""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+class PersistentLRUCache(LRUCache):
+    """An LRUCache of JSON serializable values kept in a file, e.g. to
+    remember the results of location searches across runs."""
+    def __init__(self, path, maxsize=128):
+        super(PersistentLRUCache, self).__init__(maxsize)
+        self.path = path
+        try:
+            with open(path) as f:
+                for key, value in json.load(f)[-maxsize:]:
+                    self.items[key] = value
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+
+    def put(self, key, value):
+        super(PersistentLRUCache, self).put(key, value)
+        self.save()
+
+    def clear(self):
+        super(PersistentLRUCache, self).clear()
+        self.save()
+
+    def save(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Least recently used first
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(list(self.items.items()), f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            pass
+
+
+class ResponseCache(object):
+    """Keeps the last good response of every query on disk."""
+    def __init__(self, ttl, directory=CACHE_DIR):
+        self.ttl = ttl
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, key):
+        """Returns (data, checked, validators) for a cached query or
+        (None, None, {}). validators are the HTTP headers needed to
+        revalidate it (ETag, Last-Modified)."""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            checked = datetime.fromtimestamp(os.path.getmtime(path))
+        except (IOError, OSError, ValueError):
+            return None, None, {}
+        if 'response' not in entry:
+            # Written before validators were kept
+            return entry, checked, {}
+        return entry['response'], checked, entry.get('validators') or {}
+
+    def store(self, key, data, validators=None):
+        path = self.path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'response': data, 'validators': validators or {}}, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+    def touch(self, key):
+        """Marks a cached query as checked now, e.g. after a 304."""
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+
+    def is_fresh(self, checked):
+        return (datetime.now() - checked).total_seconds() < self.ttl * 60
+
+
+class PhaseTimer(object):
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add(self.phase, clock() - self.start)
+
+
+class RefreshStats(object):
+    """Rolling timings of the last size refreshes, by phase.
+
+    Phases of a refresh are added as they run, from any thread, and a
+    phase timed several times (e.g. a retried request) adds up. end()
+    closes the refresh, keeps one sample per phase and, given a log
+    file, appends its timings to it as a JSON line. discard() drops the
+    phases of a refresh that is given up.
+    """
+    def __init__(self, size=100, log=None):
+        self.size = size
+        self.samples = dict((phase, deque(maxlen=size)) for phase in REFRESH_PHASES)
+        self.log = log
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def timer(self, phase):
+        return PhaseTimer(self, phase)
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.current[phase] = self.current.get(phase, 0) + seconds
+
+    def discard(self):
+        with self.lock:
+            self.current = {}
+
+    def end(self):
+        with self.lock:
+            current, self.current = self.current, {}
+            for phase, seconds in current.items():
+                self.samples.setdefault(phase, deque(maxlen=self.size)).append(seconds)
+        if self.log is None or not current:
+            return
+        try:
+            with open(self.log, 'a') as f:
+                f.write(json.dumps({'time': systime.time(), 'phases': current}, sort_keys=True) + '\n')
+        except (IOError, OSError):
+            pass
+
+    def percentiles(self, phase, points=(50, 90, 99)):
+        """Returns the given percentiles of a phase, in seconds, or None
+        when it has no samples."""
+        with self.lock:
+            samples = sorted(self.samples.get(phase, ()))
+        if not samples:
+            return None
+        # Nearest rank
+        return [samples[max(0, int(len(samples) * point / 100.0 + 0.5) - 1)] for point in points]
+
+    def report(self):
+        lines = ['{0:<10} {1:>5} {2:>9} {3:>9} {4:>9}'.format('phase', 'n', 'p50 ms', 'p90 ms', 'p99 ms')]
+        for phase in list(REFRESH_PHASES) + sorted(set(self.samples) - set(REFRESH_PHASES)):
+            values = self.percentiles(phase)
+            if values is not None:
+                lines.append('{0:<10} {1:>5} {2:>9.1f} {3:>9.1f} {4:>9.1f}'.format(
+                    phase, len(self.samples[phase]), *[value * 1000 for value in values]))
+        return '\n'.join(lines)
+
+
+class HTTPSession(object):
+    """Keeps persistent HTTP/1.1 connections to reuse them across
+    requests, so a refresh does not pay a new TCP (and TLS) handshake.
+
+    Connections are pooled by host, so requests made from several
+    threads at once do not share one. Responses are requested gzipped.
+    """
+    def __init__(self, connect_timeout=5, timeout=10, maxsize=4, stats=None):
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.stats = stats or RefreshStats()
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, netloc):
+        # http.client is only loaded when the network is actually needed
+        try:
+            from http.client import HTTPConnection, HTTPSConnection
+        except ImportError:
+            from httplib import HTTPConnection, HTTPSConnection
+
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        conn = cls(netloc, timeout=self.connect_timeout)
+        # Name resolution happens inside connect() too
+        with self.stats.timer('connect'):
+            conn.connect()
+        conn.sock.settimeout(self.timeout)
+        return conn
+
+    def acquire(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        return self.connect(scheme, netloc), False
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+    def get(self, url, headers=None):
+        """Returns the (status, headers, body) of a GET request. Headers
+        are returned as a dict with lower case names."""
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:
+            from urlparse import urlsplit
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'gzip'
+
+        while True:
+            conn, reused = self.acquire(parts.scheme, parts.netloc)
+            try:
+                with self.stats.timer('request'):
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                with self.stats.timer('transfer'):
+                    body = response.read()
+            except Exception:
+                conn.close()
+                if reused:
+                    # The server closed an idle connection, retry on a new one
+                    continue
+                raise
+            break
+
+        response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(parts.scheme, parts.netloc, conn)
+        if response_headers.get('content-encoding') == 'gzip':
+            with self.stats.timer('decode'):
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return response.status, response_headers, body
+
+
+def yql_quote(text):
+    """Escapes some text for a single quoted string of a YQL query."""
+    return text.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class YahooAPI(object):
+    def __init__(self, cache=None, timeout=10, url=PUBLIC_API_URL, session=None, stats=None):
+        self.cache = cache
+        self.url = url
+        self.stats = stats or RefreshStats()
+        self.session = session or HTTPSession(min(5, timeout), timeout, stats=self.stats)
+        self.checked = None
+
+    def query(self, yql, offline=False, cached=True):
+        data, checked, validators = None, None, {}
+        if cached and self.cache is not None:
+            data, checked, validators = self.cache.load(yql)
+            if data is not None and (offline or self.cache.is_fresh(checked)):
+                self.checked = checked
+                return data
+        if offline:
+            raise Exception("No cached data!")
+
+        try:
+            from urllib.parse import urlencode
+        except ImportError:
+            from urllib import urlencode
+
+        # Ask only for changes of what is cached
+        headers = {}
+        if data is not None:
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+
+        try:
+            url = self.url + '?' + urlencode({'q': yql, 'format': 'json'})
+            status, response_headers, body = self.session.get(url, headers)
+            if status == 304 and data is not None:
+                self.cache.touch(yql)
+                self.checked = datetime.now()
+                return data
+            if status != 200:
+                raise ValueError(status)
+            with self.stats.timer('decode'):
+                data = json.loads(body.decode('utf-8'))
+        except Exception:
+            raise Exception("Connection error!")
+
+        self.checked = datetime.now()
+        if cached and self.cache is not None:
+            validators = dict((name, response_headers[name]) for name in ('etag', 'last-modified')
+                              if name in response_headers)
+            self.cache.store(yql, data, validators)
+        return data
+
+
+def conv_direction(degrees):
+    if degrees is None:
+        return NOT_AVAILABLE
+    if not 0 <= degrees < 360:
+        return DIRECTIONS[0]
+    return DIRECTIONS[int((degrees + 22.5) // 45) % 8]
+
+
+def to_time(value):
+    t, p = value.split(' ')
+    h, m = map(int, t.split(':'))
+    # 12 am is midnight and 12 pm is noon
+    h %= 12
+    if p.lower() == 'pm':
+        h += 12
+    return time(h, m)
+
+
+def to_date(value):
+    """Returns the date of a date of the API, e.g. 'Sun, 18 Oct 2026
+    09:00 AM EDT', or None when it cannot be read."""
+    try:
+        day, month, year = value.split(',')[-1].split()[:3]
+        return date(int(year), MONTHS.index(month[:3].lower()) + 1, int(day))
+    except (AttributeError, ValueError):
+        return None
+
+
+def solar_date(longitude, when):
+    """Returns the date of a UTC datetime in the mean solar time of a
+    longitude."""
+    return (when + timedelta(hours=longitude / 15.0)).date()
+
+
+def solar_noon(longitude, day):
+    """Returns the solar noon of a date at a longitude, in days since
+    J2000, and the declination of the sun then, in radians."""
+    noon = (day - J2000.date()).days - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * noon) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians(math.degrees(anomaly) + center + 282.9372)
+    transit = noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    return transit, math.asin(math.sin(ecliptic) * math.sin(OBLIQUITY))
+
+
+def sun_times(latitude, longitude, day):
+    """Returns the UTC datetimes of the sunrise and sunset of a date at
+    some coordinates, or None when the sun does not rise or set."""
+    transit, declination = solar_noon(longitude, day)
+    latitude = math.radians(latitude)
+    cos_hour = ((math.sin(SUNRISE_ALTITUDE) - math.sin(latitude) * math.sin(declination)) /
+                (math.cos(latitude) * math.cos(declination)))
+    if not -1 <= cos_hour <= 1:
+        return None
+    half_day = math.acos(cos_hour) / (2 * math.pi)
+    return J2000 + timedelta(days=transit - half_day), J2000 + timedelta(days=transit + half_day)
+
+
+def sun_altitude(latitude, longitude, when):
+    """Returns the altitude of the sun, in radians, at some coordinates
+    and UTC datetime."""
+    transit, declination = solar_noon(longitude, solar_date(longitude, when))
+    hour = 2 * math.pi * ((when - J2000).total_seconds() / 86400 - transit)
+    latitude = math.radians(latitude)
+    return math.asin(math.sin(latitude) * math.sin(declination) +
+                     math.cos(latitude) * math.cos(declination) * math.cos(hour))
+
+
+def utc_offset(local, utc, tolerance=5):
+    """Returns the offset in minutes from a UTC datetime to the local time
+    of the same moment, rounded to quarter hours as time zones are, or
+    None when they are more than tolerance minutes away from any such
+    offset."""
+    minutes = ((local.hour - utc.hour) * 60 + local.minute - utc.minute) % (24 * 60)
+    offset = int(round(minutes / 15.0)) * 15
+    if abs(minutes - offset) > tolerance:
+        return None
+    offset %= 24 * 60
+    return offset - 24 * 60 if offset > 14 * 60 else offset
+
+
+def to_local_time(utc, offset):
+    """Returns the local time of a UTC datetime, to the nearest minute."""
+    return (utc + timedelta(minutes=offset, seconds=30)).time().replace(second=0, microsecond=0)
+
+
+def day_night_icon(name, daytime):
+    """Returns the day or night variant of an icon name."""
+    if daytime:
+        return DAY_ICONS.get(name, name)
+    return NIGHT_ICONS.get(name, name)
+
+
+def next_sun_event(records, now=None):
+    """Returns the seconds until the next sunrise or sunset at any of the
+    locations of some records, or None when it is not known."""
+    now = now or datetime.utcnow()
+    events = [event for event in (record.next_sun_event(now) for record in records) if event is not None]
+    if not events:
+        return None
+    return (min(events) - now).total_seconds()
+
+
+def convert(value, quantity, units):
+    """Converts a canonical value of a quantity to the given units."""
+    if units == CANONICAL_UNITS:
+        return value
+    factor, offset = CONVERSIONS[quantity]
+    return value * factor + offset
+
+
+def to_canonical(value, quantity, units):
+    """Converts a value of a quantity in the given units to canonical."""
+    if units == CANONICAL_UNITS:
+        return value
+    factor, offset = CONVERSIONS[quantity]
+    return (value - offset) / factor
+
+
+def format_number(value):
+    return '{0:g}'.format(value)
+
+
+def to_number(text, type=float):
+    """Returns a number of the API, or None when it is missing or not a
+    number."""
+    try:
+        return type(float(text))
+    except (TypeError, ValueError):
+        return None
+
+
+def format_quantity(value, quantity, units):
+    if value is None:
+        return NOT_AVAILABLE
+    unit = UNITS[units][quantity]
+    return u'{0} {1}'.format(format_number(round(convert(value, quantity, units), PRECISION[unit])), unit)
+
+
+def format_percent(value):
+    if value is None:
+        return NOT_AVAILABLE
+    return '{0}%'.format(value)
+
+
+def format_temp(value, units):
+    return u'{0}\u00B0 {1}'.format(format_number(round(convert(value, 'temperature', units))), UNITS[units]['temperature'])
+
+
+def format_trend(trend, units):
+    """Formats the (sparkline, minimum, maximum) temperatures of a trend."""
+    line, low, high = trend
+    return u'{0} {1} \u2013 {2}'.format(line, format_temp(low, units), format_temp(high, units))
+
+
+def format_age(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return 'less than a minute'
+    if minutes < 60:
+        return '{0} min'.format(minutes)
+    if minutes < 24 * 60:
+        return '{0} h'.format(minutes // 60)
+    return '{0} d'.format(minutes // (24 * 60))
+
+
+def sparkline(values):
+    """Returns a line of block characters for some values, with a space
+    for every missing (None) one."""
+    known = [value for value in values if value is not None]
+    if not known:
+        return u''
+    low, high = min(known), max(known)
+    scale = (len(SPARKS) - 1) / float(high - low) if high > low else 0
+    return u''.join(u' ' if value is None else SPARKS[int(round((value - low) * scale))] for value in values)
+
+
+class Forecast(object):
+    """Forecast of a single day."""
+    __slots__ = ('code', 'date', 'day', 'text', 'high', 'low')
+
+    def __init__(self, code, date, day, text, high, low):
+        self.code = code
+        self.date = date
+        self.day = day
+        self.text = text
+        self.high = high
+        self.low = low
+
+    def __eq__(self, other):
+        return isinstance(other, Forecast) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Forecast{0!r}'.format(self.to_tuple())
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+class Weather(object):
+    """Weather of a location, as parsed once from a provider response.
+
+    Values are kept as numbers in the canonical units, sunrise and sunset
+    as datetime.time in the local time of the location, utc_offset in
+    minutes and checked as the datetime of the response; they are only
+    converted and formatted when rendered.
+    """
+    __slots__ = ('woeid', 'city', 'country', 'code', 'text', 'temp',
+                 'wind_direction', 'wind_speed', 'humidity', 'visibility',
+                 'pressure', 'sunrise', 'sunset', 'forecast', 'ttl', 'checked',
+                 'latitude', 'longitude', 'utc_offset')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __eq__(self, other):
+        return isinstance(other, Weather) and self.to_tuple() == other.to_tuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Weather({0})'.format(', '.join('{0}={1!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def age(self):
+        """Returns the seconds since the record was checked."""
+        return (datetime.now() - self.checked).total_seconds()
+
+    def is_daytime(self, now=None):
+        """Tells whether the sun is up at the location, now or at some UTC
+        datetime."""
+        if self.latitude is None:
+            # Without coordinates, compare the times of the response
+            # with the local clock
+            if now is None:
+                now = datetime.now()
+            else:
+                now = datetime.fromtimestamp((now - datetime(1970, 1, 1)).total_seconds())
+            return self.sunrise <= now.time() < self.sunset
+        return sun_altitude(self.latitude, self.longitude, now or datetime.utcnow()) > SUNRISE_ALTITUDE
+
+    def next_sun_event(self, now=None):
+        """Returns the UTC datetime of the next sunrise or sunset at the
+        location, or None without coordinates or during polar days and
+        nights."""
+        if self.latitude is None:
+            return None
+        now = now or datetime.utcnow()
+        day = solar_date(self.longitude, now)
+        for days in range(3):
+            times = sun_times(self.latitude, self.longitude, day + timedelta(days=days))
+            if times is not None:
+                for event in times:
+                    if event > now:
+                        return event
+        return None
+
+    def icon(self, icons, now=None):
+        """Returns the icon of the condition, in its day or night
+        variant as the sun is now."""
+        return day_night_icon(icons.get(self.code), self.is_daytime(now))
+
+    def to_dict(self):
+        """Returns a JSON serializable dict of the record."""
+        data = dict((name, getattr(self, name)) for name in self.__slots__)
+        data['sunrise'] = self.sunrise.strftime('%H:%M')
+        data['sunset'] = self.sunset.strftime('%H:%M')
+        data['forecast'] = [f.to_tuple() for f in self.forecast]
+        data['checked'] = systime.mktime(self.checked.timetuple()) + self.checked.microsecond / 1e6
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data['sunrise'] = datetime.strptime(data['sunrise'], '%H:%M').time()
+        data['sunset'] = datetime.strptime(data['sunset'], '%H:%M').time()
+        data['forecast'] = [Forecast(*f) for f in data['forecast']]
+        data['checked'] = datetime.fromtimestamp(data['checked'])
+        return cls(**data)
+
+
+def diff_weather(old, new, icons, severe, units, above=None, below=None, days=2):
+    """Returns the (summary, body) of every meaningful change between two
+    snapshots: a location whose condition turns severe (one of the
+    severe codes), a temperature crossing the above or below thresholds
+    (in the given units) and a forecast of the next days whose icon
+    flips. Other changes are not worth a notification."""
+    changes = []
+    previous = dict((record.woeid, record) for record in old or ())
+    for record in new:
+        before = previous.get(record.woeid)
+        if before is None:
+            continue
+        if record.code in severe and before.code not in severe:
+            changes.append((record.city, u'{0} now'.format(record.text)))
+
+        temp, temp_before = convert(record.temp, 'temperature', units), convert(before.temp, 'temperature', units)
+        if above is not None and temp_before <= above < temp:
+            changes.append((record.city, u'Temperature up to {0}'.format(format_temp(record.temp, units))))
+        if below is not None and temp_before >= below > temp:
+            changes.append((record.city, u'Temperature down to {0}'.format(format_temp(record.temp, units))))
+
+        forecast_before = dict((item.date, item) for item in before.forecast)
+        for item in record.forecast[:days]:
+            item_before = forecast_before.get(item.date)
+            if item_before is not None and icons.get(item.code) != icons.get(item_before.code):
+                changes.append((record.city, u'{0} forecast: {1} instead of {2}'.format(item.day, item.text, item_before.text)))
+    return changes
+
+
+def encode_snapshot(records=None, error=None):
+    """Encodes a weatherboyd message: the weather of every location, or
+    the error of the last refresh. Messages are JSON lines."""
+    if error is not None:
+        message = {'error': error}
+    else:
+        message = {'weather': [record.to_dict() for record in records]}
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def decode_snapshot(line):
+    """Returns the (records, error) of a weatherboyd message."""
+    message = json.loads(line.decode('utf-8'))
+    if 'error' in message:
+        return None, message['error']
+    return [Weather.from_dict(data) for data in message['weather']], None
+
+
+class WeatherProvider(object):
+    """A source of weather data.
+
+    fetch() returns the raw response for some locations and parse()
+    turns it into one Weather record per location. Weather codes follow
+    the Yahoo! Weather ones.
+    """
+    def __init__(self, api):
+        self.api = api
+
+    def fetch(self, locations, offline=False):
+        raise NotImplementedError
+
+    def parse(self, response):
+        raise NotImplementedError
+
+    def forecast(self, locations, offline=False):
+        response = self.fetch(locations, offline)
+        with self.api.stats.timer('parse'):
+            records = self.parse(response)
+        # Records are matched to their locations by WOEID, or by position
+        # when the provider does not give it. Unknown locations are dropped.
+        if len(records) == len(locations) and all(record.woeid is None for record in records):
+            for record, location in zip(records, locations):
+                record.woeid = location
+        found = dict((record.woeid, record) for record in records)
+        if not any(location in found for location in locations):
+            raise Exception("Unknown location: {0}".format(', '.join(locations)))
+        return [found[location] for location in locations if location in found]
+
+
+class YahooProvider(WeatherProvider):
+    def query(self, locations):
+        # All locations are fetched in a single round-trip
+        woeids = ','.join("'%s'" % woeid for woeid in locations)
+        return YQL_FORECAST_BY_WOEID % (woeids, CANONICAL_UNITS)
+
+    def fetch(self, locations, offline=False):
+        return self.api.query(self.query(locations), offline)
+
+    def parse(self, response):
+        if not response['query']['results']:
+            return []
+        channels = response['query']['results']['channel']
+        if not isinstance(channels, list):
+            channels = [channels]
+
+        return [self.parse_channel(channel) for channel in channels]
+
+    def parse_channel(self, channel):
+        condition = channel['item']['condition']
+        wind = channel['wind']
+        atmosphere = channel['atmosphere']
+        astronomy = channel['astronomy']
+        units = channel['units']['temperature'].lower()
+
+        def value(text, quantity):
+            return to_canonical(float(text), quantity, units)
+
+        # Conditions other than the temperature may be missing or empty
+        # for some locations, they are kept as None
+        def optional(text, quantity):
+            number = to_number(text)
+            return None if number is None else to_canonical(number, quantity, units)
+
+        # Sunrise and sunset are computed from the coordinates. The time
+        # zone of the location is not in the response, it is recovered
+        # from the local times of its astronomy block, which are of the
+        # local date of the response (it may be an old one, e.g. from the
+        # cache). Without a date or a plausible offset, the times of the
+        # response are kept.
+        sunrise, sunset = to_time(astronomy['sunrise']), to_time(astronomy['sunset'])
+        latitude, longitude, offset = channel['item'].get('lat'), channel['item'].get('long'), None
+        day = to_date(condition.get('date') or channel['item'].get('pubDate') or channel.get('lastBuildDate'))
+        if latitude is not None and longitude is not None:
+            latitude, longitude = float(latitude), float(longitude)
+            times = sun_times(latitude, longitude, day) if day is not None else None
+            if times is not None:
+                offset = utc_offset(sunrise, times[0])
+                if offset is not None and offset == utc_offset(sunset, times[1]):
+                    sunrise, sunset = [to_local_time(event, offset) for event in times]
+                else:
+                    offset = None
+
+        link = LINK_WOEID.search(channel['item'].get('link') or channel.get('link') or '')
+
+        return Weather(
+            woeid=link.group(1) if link else None,
+            city=channel['location']['city'],
+            country=channel['location']['country'],
+            code=condition['code'],
+            text=condition['text'],
+            temp=value(condition['temp'], 'temperature'),
+            wind_direction=to_number(wind.get('direction'), int),
+            wind_speed=optional(wind.get('speed'), 'speed'),
+            humidity=to_number(atmosphere.get('humidity'), int),
+            visibility=optional(atmosphere.get('visibility'), 'distance'),
+            pressure=optional(atmosphere.get('pressure'), 'pressure'),
+            sunrise=sunrise,
+            sunset=sunset,
+            forecast=[Forecast(item['code'], item['date'], item['day'], item['text'],
+                               value(item['high'], 'temperature'), value(item['low'], 'temperature'))
+                      for item in channel['item']['forecast']],
+            ttl=int(channel.get('ttl', 60)),
+            checked=self.api.checked,
+            latitude=latitude,
+            longitude=longitude,
+            utc_offset=offset)
+
+
+class RefreshScheduler(object):
+    """Decides how many seconds to wait before the next refresh.
+
+    After a good refresh it waits delta minutes, or until the provider
+    publishes new data (the ttl of the records) when that is later.
+    Failed refreshes back off exponentially from delta up to max_backoff
+    minutes. Every delay gets a random jitter so that many instances do
+    not poll in lockstep, e.g. after a resume.
+    """
+    def __init__(self, delta, max_backoff=60, jitter=0.1, resume_delay=15):
+        self.delta = delta * 60
+        self.max_backoff = max(max_backoff * 60, self.delta)
+        self.jitter = jitter
+        self.resume_delay = resume_delay
+        self.failures = 0
+        self.next_data = 0
+
+    def succeeded(self, records):
+        self.failures = 0
+        self.next_data = max(0, min(
+            record.ttl * 60 - (datetime.now() - record.checked).total_seconds()
+            for record in records))
+
+    def failed(self):
+        self.failures += 1
+
+    def add_jitter(self, seconds):
+        return seconds * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def delay(self):
+        if self.failures:
+            seconds = min(self.delta * 2 ** (self.failures - 1), self.max_backoff)
+        else:
+            seconds = max(self.delta, self.next_data)
+        return self.add_jitter(seconds)
+
+    def delay_after_resume(self):
+        # Give the network some time to come back
+        return self.add_jitter(self.resume_delay)
+
+
+# Weather providers by name
+PROVIDERS = {
+    'yahoo': YahooProvider
+}
+
+
+def normalize_name(text):
+    """Returns the search key of a place name: lower case, without
+    accents and with single spaces."""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return u' '.join(text.lower().split())
+
+
+class Place(object):
+    __slots__ = ('woeid', 'name', 'label', 'latitude', 'longitude')
+
+    def __init__(self, woeid, name, label, latitude, longitude):
+        self.woeid = woeid
+        self.name = name
+        self.label = label
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __repr__(self):
+        return 'Place({0!r}, {1!r}, {2!r}, {3!r}, {4!r})'.format(
+            self.woeid, self.name, self.label, self.latitude, self.longitude)
+
+
+class Gazetteer(object):
+    """An offline index of places, searched by name prefix or by
+    coordinates, read through mmap without loading it.
+
+    File layout, little endian:
+
+    - header: magic, place count, offset of the k-d tree and of the
+      string pool.
+    - places: one fixed size record each (WOEID, latitude and longitude
+      in microdegrees, offsets of the search key and of the label),
+      sorted by search key so that the places of a prefix are a range
+      found by binary search.
+    - k-d tree: one node per place (place index and its position as a
+      unit vector), stored implicitly with the median of every range in
+      its middle.
+    - string pool: NUL terminated UTF-8 strings.
+    """
+    MAGIC = b'WBG1'
+    HEADER = struct.Struct('<4sIII')
+    RECORD = struct.Struct('<IiiII')
+    NODE = struct.Struct('<Ifff')
+
+    def __init__(self, path=GAZETTEER_PATH):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.count, self.tree, self.strings = self.HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            magic = None
+        if magic != self.MAGIC:
+            self.map.close()
+            raise ValueError("Not a weatherboy gazetteer: {0}".format(path))
+        # A truncated file would fail on some lookups only
+        if not (self.HEADER.size + self.count * self.RECORD.size <= self.tree and
+                self.tree + self.count * self.NODE.size <= self.strings <= len(self.map)):
+            self.map.close()
+            raise ValueError("Truncated weatherboy gazetteer: {0}".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def string(self, offset):
+        start = self.strings + offset
+        return self.map[start:self.map.find(b'\0', start)].decode('utf-8')
+
+    def record(self, index):
+        return self.RECORD.unpack_from(self.map, self.HEADER.size + index * self.RECORD.size)
+
+    def key(self, index):
+        return self.string(self.record(index)[3])
+
+    def place(self, index):
+        woeid, latitude, longitude, key, label = self.record(index)
+        label = self.string(label)
+        return Place(str(woeid), label.split(u', ')[0], label, latitude / 1e6, longitude / 1e6)
+
+    def search(self, prefix, limit=10):
+        """Returns the places whose name starts with prefix."""
+        prefix = normalize_name(prefix)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        places = []
+        while lo < self.count and len(places) < limit and self.key(lo).startswith(prefix):
+            places.append(self.place(lo))
+            lo += 1
+        return places
+
+    def resolve(self, name):
+        """Returns the place of an exact name, or of the first one it is a
+        prefix of, or None."""
+        places = self.search(name, 1)
+        return places[0] if places else None
+
+    def node(self, position):
+        return self.NODE.unpack_from(self.map, self.tree + position * self.NODE.size)
+
+    def nearest(self, latitude, longitude):
+        """Returns the place closest to some coordinates, or None."""
+        if not self.count:
+            return None
+        target = to_vector(latitude, longitude)
+        best = [None, float('inf')]
+        stack = [(0, self.count, 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            node = self.node(mid)
+            distance = sum((a - b) ** 2 for a, b in zip(node[1:], target))
+            if distance < best[1]:
+                best = [node[0], distance]
+            delta = target[axis] - node[1 + axis]
+            near, far = ((lo, mid), (mid + 1, hi)) if delta < 0 else ((mid + 1, hi), (lo, mid))
+            # The far side only matters when the splitting plane is closer
+            # than the best place so far
+            if delta ** 2 < best[1]:
+                stack.append(far + ((axis + 1) % 3,))
+            stack.append(near + ((axis + 1) % 3,))
+        return self.place(best[0])
+
+    @classmethod
+    def build(cls, places, path):
+        """Writes the index of some places (WOEID, name, admin2, admin1,
+        country, latitude, longitude) to path."""
+        entries = []
+        for woeid, name, admin2, admin1, country, latitude, longitude in places:
+            label = u', '.join(part for part in (name, admin2, admin1, country) if part)
+            entries.append((normalize_name(name), int(woeid), label, float(latitude), float(longitude)))
+        entries.sort()
+
+        strings = bytearray()
+        offsets = {}
+
+        def intern(text):
+            if text not in offsets:
+                offsets[text] = len(strings)
+                strings.extend(text.encode('utf-8') + b'\0')
+            return offsets[text]
+
+        records = bytearray()
+        for key, woeid, label, latitude, longitude in entries:
+            records.extend(cls.RECORD.pack(woeid, int(round(latitude * 1e6)), int(round(longitude * 1e6)),
+                                           intern(key), intern(label)))
+
+        tree = [None] * len(entries)
+        points = [(index,) + to_vector(entry[3], entry[4]) for index, entry in enumerate(entries)]
+        stack = [(0, len(points), 0, points)]
+        while stack:
+            lo, hi, axis, items = stack.pop()
+            if not items:
+                continue
+            items.sort(key=lambda item: item[1 + axis])
+            mid = (lo + hi) // 2
+            tree[mid] = items[mid - lo]
+            stack.append((lo, mid, (axis + 1) % 3, items[:mid - lo]))
+            stack.append((mid + 1, hi, (axis + 1) % 3, items[mid - lo + 1:]))
+
+        nodes = bytearray()
+        for node in tree:
+            nodes.extend(cls.NODE.pack(*node))
+
+        tree_offset = cls.HEADER.size + len(records)
+        header = cls.HEADER.pack(cls.MAGIC, len(entries), tree_offset, tree_offset + len(nodes))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(header)
+            f.write(records)
+            f.write(nodes)
+            f.write(strings)
+        os.rename(path + '.tmp', path)
+
+
+def to_vector(latitude, longitude):
+    """Returns the unit vector of some coordinates, so that distances
+    between places do not depend on where the meridians wrap."""
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def resolve_locations(locations, path=GAZETTEER_PATH):
+    """Returns the WOEIDs of some locations given as WOEIDs or as place
+    names, looked up in the offline gazetteer."""
+    if all(location.isdigit() for location in locations):
+        return list(locations)
+    try:
+        gazetteer = Gazetteer(path)
+    except (IOError, OSError, ValueError):
+        raise Exception("No offline gazetteer to look up place names!")
+    try:
+        woeids = []
+        for location in locations:
+            if location.isdigit():
+                woeids.append(location)
+                continue
+            place = gazetteer.resolve(location)
+            if place is None:
+                raise Exception("Unknown location: {0}".format(location))
+            woeids.append(place.woeid)
+        return woeids
+    finally:
+        gazetteer.close()
+
+
+class HistoryStore(object):
+    """Observations of every location, kept in SQLite for some days.
+
+    Rows are keyed by location and time of the response, so the same
+    response stored twice, e.g. by several instances, is kept once and
+    time ranges of a location are read through the primary key.
+    """
+    SCHEMA = """CREATE TABLE IF NOT EXISTS observations (
+        woeid TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        temp REAL,
+        pressure REAL,
+        humidity INTEGER,
+        wind_speed REAL,
+        wind_direction INTEGER,
+        code INTEGER,
+        PRIMARY KEY (woeid, time)
+    ) WITHOUT ROWID"""
+
+    def __init__(self, path=HISTORY_PATH, retention=30):
+        self.path = path
+        self.retention = retention
+        self.db = None
+        # Used from worker threads, one at a time
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.db is None:
+            import sqlite3
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.db.execute(self.SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def add(self, records):
+        """Appends the observations of some records and drops the ones
+        older than the retention days."""
+        import sqlite3
+        oldest = int(systime.time()) - self.retention * 24 * 3600
+        try:
+            with self.lock:
+                db = self.connect()
+                with db:
+                    for record in records:
+                        db.execute('DELETE FROM observations WHERE woeid = ? AND time < ?', (record.woeid, oldest))
+                        checked = int(systime.mktime(record.checked.timetuple()))
+                        if checked >= oldest:
+                            db.execute('INSERT OR IGNORE INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                       (record.woeid, checked, record.temp, record.pressure, record.humidity,
+                                        record.wind_speed, record.wind_direction, int(record.code)))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def buckets(self, woeid, seconds, count, field='temp'):
+        """Splits the last seconds into count buckets and returns the
+        (average, minimum, maximum) of a field in every one of them, or
+        None for the buckets without observations."""
+        import sqlite3
+        if field not in ('temp', 'pressure', 'humidity', 'wind_speed'):
+            raise ValueError(field)
+        start = systime.time() - seconds
+        width = seconds / float(count)
+        result = [None] * count
+        try:
+            with self.lock:
+                rows = self.connect().execute(
+                    'SELECT CAST((time - ?) / ? AS INTEGER) AS bucket, AVG({0}), MIN({0}), MAX({0}) '
+                    'FROM observations WHERE woeid = ? AND time >= ? GROUP BY bucket'.format(field),
+                    (start, width, woeid, start)).fetchall()
+            for bucket, average, low, high in rows:
+                if 0 <= bucket < count and average is not None:
+                    result[bucket] = (average, low, high)
+        except (sqlite3.Error, OSError):
+            pass
+        return result
+
+    def trend(self, woeid, seconds, count, field='temp'):
+        """Returns the (sparkline, minimum, maximum) of a field in the last
+        seconds, or None without observations."""
+        buckets = self.buckets(woeid, seconds, count, field)
+        known = [bucket for bucket in buckets if bucket is not None]
+        if not known:
+            return None
+        return (sparkline([bucket and bucket[0] for bucket in buckets]),
+                min(bucket[1] for bucket in known), max(bucket[2] for bucket in known))
+
+    def trends(self, records):
+        """Returns the (label, trend) of every range of TRENDS with
+        observations, by WOEID of the records. It blocks on SQLite, so
+        frontends call it off their event loop."""
+        result = {}
+        for record in records:
+            result[record.woeid] = [(label, trend) for label, trend in
+                                    ((label, self.trend(record.woeid, seconds, count))
+                                     for label, seconds, count in TRENDS)
+                                    if trend is not None]
+        return result
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <https://www.gnu.org/licenses/gpl-3.0.html>.
+#
+# License: GPLv3
+# Website: https://github.com/abbarrasa/openbox
+#
+# A headless weather daemon. It fetches the weather of some locations
+# once and pushes every new snapshot to the weatherboy and weatherboy-qt
+# instances started with --client, over a Unix socket. Clients receive
+# one JSON line per snapshot and may send the line 'refresh' to ask for
+# a refresh.
+#
+# The socket is only open to the user running the daemon. To share one
+# daemon between several users or seats, put the socket in a directory
+# all of them can reach and open it to a group they belong to:
+#
+#   sudo install -d -m 750 -g weather /run/weatherboy
+#   python3 weatherboyd.py -l 766273 -s /run/weatherboy/weatherboyd.sock --mode 660 --group weather
+#
+# and start the tray of every user with --client -s /run/weatherboy/weatherboyd.sock.
+#
+# Example of use: python3 weatherboyd.py -l 22664159 766273 -d 30 &
+#                 python3 weatherboy-qt.py --client -a
+
+from argparse import ArgumentParser
+import grp
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+from weatherboy_core import (PUBLIC_API_URL, PROVIDERS, SNAPSHOT_SOCKET,
+    HistoryStore, RefreshScheduler, ResponseCache, YahooAPI, encode_snapshot,
+    resolve_locations)
+
+
+def parse_arguments():
+    parser = ArgumentParser(description='Headless weather daemon',
+                            epilog='Free software under GPL license.'
+                            'Please, report bugs and comments on https://github.com/abbarrasa/openbox')
+    parser.add_argument('-l', '--location',
+                        required=True,
+                        nargs='+',
+                        metavar='WOEID',
+                        help='location WOEIDs or names in the offline gazetteer (more on https://developer.yahoo.com/weather/)')
+    parser.add_argument('-d', '--delta',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='minimum timeout in minutes between weather data queries; a longer ttl of the provider takes precedence')
+    parser.add_argument('-b', '--backoff',
+                        default='60',
+                        type=int,
+                        metavar='N',
+                        help='maximum timeout in minutes between retries after a connection error')
+    parser.add_argument('-t', '--ttl',
+                        default='5',
+                        type=int,
+                        metavar='N',
+                        help='time in minutes a cached weather data query is still valid')
+    parser.add_argument('-T', '--timeout',
+                        default='10',
+                        type=int,
+                        metavar='N',
+                        help='timeout in seconds for a weather data query')
+    parser.add_argument('-p', '--provider',
+                        choices=sorted(PROVIDERS),
+                        default='yahoo',
+                        help='weather data provider')
+    parser.add_argument('--api-url',
+                        default=PUBLIC_API_URL,
+                        metavar='URL',
+                        help='weather API endpoint (e.g. a local weatherboy-replay server)')
+    parser.add_argument('-s', '--socket',
+                        default=SNAPSHOT_SOCKET,
+                        metavar='PATH',
+                        help='Unix socket to publish snapshots on')
+    parser.add_argument('-H', '--history',
+                        default='30',
+                        type=int,
+                        metavar='N',
+                        help='days of weather history recorded for the trends of clients, 0 to record none')
+    parser.add_argument('--mode',
+                        default='600',
+                        type=lambda value: int(value, 8),
+                        metavar='MODE',
+                        help='octal permissions of the socket, e.g. 660 to share it with --group')
+    parser.add_argument('--group',
+                        metavar='GROUP',
+                        help='group name or id that owns the socket')
+    args = parser.parse_args()
+    if args.group is not None:
+        try:
+            args.group = int(args.group) if args.group.isdigit() else grp.getgrnam(args.group).gr_gid
+        except KeyError:
+            parser.error('unknown group: {0}'.format(args.group))
+    try:
+        args.location = resolve_locations(args.location)
+    except Exception as e:
+        parser.error(str(e))
+    return args
+
+
+class SnapshotServer(object):
+    """Sends the latest snapshot to every client of a Unix socket."""
+    def __init__(self, path, mode=0o600, group=None):
+        self.path = path
+        self.snapshot = None
+        self.refresh_requested = False
+        self.clients = {}
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # Nobody is listening, a left over socket file can go
+            if os.path.exists(path):
+                os.unlink(path)
+        else:
+            raise Exception("Another daemon is listening on {0}".format(path))
+        finally:
+            probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created private and only then opened as asked, so nobody
+        # connects in between
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        if group is not None:
+            os.chown(path, -1, group)
+        os.chmod(path, mode)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+
+    def close(self):
+        for conn in list(self.clients):
+            self.drop(conn)
+        self.selector.close()
+        self.sock.close()
+        os.unlink(self.path)
+
+    def accept(self, sock):
+        conn, _ = sock.accept()
+        conn.settimeout(1.0)
+        self.clients[conn] = b''
+        self.selector.register(conn, selectors.EVENT_READ, self.read)
+        if self.snapshot is not None:
+            self.send(conn, self.snapshot)
+
+    def read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(conn)
+            return
+
+        lines = (self.clients[conn] + data).split(b'\n')
+        self.clients[conn] = lines.pop()
+        for line in lines:
+            if line.strip() == b'refresh':
+                self.refresh_requested = True
+
+    def send(self, conn, message):
+        try:
+            conn.sendall(message)
+        except OSError:
+            self.drop(conn)
+
+    def drop(self, conn):
+        self.selector.unregister(conn)
+        del self.clients[conn]
+        conn.close()
+
+    def publish(self, message, latest=True):
+        """Sends a message to every client. The latest one is also sent
+        to clients connecting later."""
+        if latest:
+            self.snapshot = message
+        for conn in list(self.clients):
+            self.send(conn, message)
+
+    def serve(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            key.data(key.fileobj)
+
+
+class Daemon(object):
+    def __init__(self, args):
+        self.args = args
+        self.api = YahooAPI(ResponseCache(args.ttl), args.timeout, args.api_url)
+        self.provider = PROVIDERS[args.provider](self.api)
+        self.scheduler = RefreshScheduler(args.delta, args.backoff)
+        self.server = SnapshotServer(args.socket, args.mode, args.group)
+        self.history = HistoryStore(retention=args.history) if args.history > 0 else None
+
+    def refresh(self):
+        try:
+            records = self.provider.forecast(self.args.location)
+        except Exception as e:
+            print(str(e))
+            self.scheduler.failed()
+            # New clients still get the last good snapshot
+            self.server.publish(encode_snapshot(error=str(e)), latest=self.server.snapshot is None)
+        else:
+            self.scheduler.succeeded(records)
+            self.server.publish(encode_snapshot(records))
+            # Clients only read the history, the daemon records it once
+            if self.history is not None:
+                self.history.add(records)
+
+    def run(self):
+        # Clients connecting before the first refresh get the cached data
+        try:
+            self.server.snapshot = encode_snapshot(self.provider.forecast(self.args.location, offline=True))
+        except Exception:
+            pass
+
+        deadline = time.monotonic()
+        try:
+            while True:
+                if self.server.refresh_requested or time.monotonic() >= deadline:
+                    self.server.refresh_requested = False
+                    self.refresh()
+                    deadline = time.monotonic() + self.scheduler.delay()
+                self.server.serve(max(0, deadline - time.monotonic()))
+        finally:
+            self.server.close()
+
+
+if __name__ == "__main__":
+    try:
+        args = parse_arguments()
+        # Leave through the finally clauses so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        Daemon(args).run()
+    except KeyboardInterrupt:
+        pass